@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import argparse, sys
+import asyncio, sqlite3, json, time
+from concurrent.futures import ThreadPoolExecutor
+import db
+from history import Backoff, PageSize, read_offset, write_offset
+
+
+class Chat:
+    """
+        Dump state of one chat database
+    """
+
+    def __init__(self, name, channel_id, offset=0):
+        self.name = name
+        self.channel_id = channel_id
+        self.offset = offset
+        self.committed = offset
+        self.checkpointed = time.time()
+        self.pending = 0
+        self.added = 0
+        self.done = False
+        self.codec = None
+
+        self.conn = sqlite3.connect("%s.db" % name, check_same_thread=False)
+        self.c = self.conn.cursor()
+
+
+def open_chat(spec, journal="WAL", synchronous="NORMAL", continue_dump=False):
+    """
+        Open chat database given as "name" or "name:id". With an id a new
+        database is initialised, otherwise the id is read from the database.
+    """
+
+    name, _, channel_id = spec.partition(":")
+
+    if channel_id:
+        if len(channel_id) != 32:
+            raise ValueError("Invalid dialog ID! %s" % channel_id)
+        channel_id = "$" + channel_id
+
+    conn = sqlite3.connect("%s.db" % name)
+    c = conn.cursor()
+    if channel_id and not c.execute("SELECT name FROM sqlite_master WHERE name = 'messages';").fetchone():
+        print("%s: Creating tables.." % name)
+        db.create_tables(c)
+        conn.commit()
+    elif not channel_id:
+        try:
+            channel_id = db.channel_id(c)
+        except (sqlite3.OperationalError, KeyError, ValueError, TypeError):
+            raise ValueError("Failed to read channel ID of %s! Uninitialized or empty database!" % name)
+    conn.close()
+
+    chat = Chat(name, channel_id, read_offset(name) if continue_dump else 0)
+    chat.codec = db.load_codec(chat.c)
+    db.configure(chat.conn, journal, synchronous)
+    return chat
+
+
+async def request(host, port, command, timeout=30.0):
+    """
+        Send a command to the telegram-cli JSON port and return the decoded answer
+    """
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(command.encode() + b"\n")
+        await writer.drain()
+
+        # Answers are framed as "ANSWER <bytes>\n<json>"
+        header = await asyncio.wait_for(reader.readline(), timeout)
+        if not header.startswith(b"ANSWER "):
+            raise ValueError("Unexpected response %r" % header[:80])
+        data = await asyncio.wait_for(reader.readexactly(int(header[7:])), timeout)
+        return json.loads(data.decode())
+    finally:
+        writer.close()
+
+
+async def dump_chat(chat, args, limit, queue):
+    """
+        Fetch history pages of one chat and pass them to the writer
+    """
+
+    backoff = Backoff(args.backoff)
+    if args.fixed_step:
+        pages = PageSize(args.step, args.step, args.step)
+    else:
+        pages = PageSize(args.step, maximum=args.max_step)
+    failures = 0
+
+    while not chat.done:
+        try:
+            async with limit:
+                start = time.time()
+                res = await request(args.host, args.port, "history %s %d %d" % (chat.channel_id, pages.size, chat.offset), args.timeout)
+                elapsed = time.time() - start
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            failures += 1
+            if failures > args.retries:
+                print("%s: Giving up after %d failures (%s)" % (chat.name, failures, e))
+                break
+            delay = backoff.failure()
+            print("%s: Empty response (%s), retrying in %.2f s with %d messages" % (
+                chat.name, str(e) or type(e).__name__, delay, pages.failure()))
+            await asyncio.sleep(delay)
+            continue
+
+        if isinstance(res, dict):
+            print("%s: %s" % (chat.name, res))
+            break
+
+        failures = 0
+        backoff.success()
+        pages.success(elapsed)
+
+        # Beginning of the history
+        if not res:
+            break
+
+        chat.offset += len(res)
+        await queue.put((chat, res, chat.offset))
+
+
+def write_page(chat, page, offset, args):
+    """
+        Insert a page of messages. Runs in the writer thread.
+    """
+
+    new_messages = db.insert_messages(chat.c, page, chat.codec)
+    chat.pending += len(page)
+    chat.added += new_messages
+    print("%s: Added %d, collisions %d" % (chat.name, new_messages, len(page) - new_messages))
+
+    # A page of only stored messages means the rest is dumped already
+    if not args.continue_dump and new_messages == 0:
+        chat.done = True
+
+    if chat.pending >= args.batch or time.time() - chat.checkpointed >= args.checkpoint:
+        checkpoint(chat, offset)
+
+
+def checkpoint(chat, offset):
+    """
+        Commit the pending messages and store the offset after them
+    """
+
+    chat.conn.commit()
+    write_offset(chat.name, offset)
+    chat.pending = 0
+    chat.committed = offset
+    chat.checkpointed = time.time()
+
+
+async def write_pages(queue, args):
+    """
+        Single writer task: all database writes go through one thread so
+        fetching continues while pages are inserted and committed
+    """
+
+    loop = asyncio.get_running_loop()
+    offsets = {}
+
+    with ThreadPoolExecutor(1) as executor:
+        while True:
+            chat, page, offset = await queue.get()
+            if chat is None:
+                break
+            offsets[chat] = offset
+            await loop.run_in_executor(executor, write_page, chat, page, offset, args)
+
+        for chat, offset in offsets.items():
+            await loop.run_in_executor(executor, checkpoint, chat, offset)
+
+
+async def dump(chats, args):
+    """
+        Dump all chats concurrently with at most args.concurrency requests in flight
+    """
+
+    queue = asyncio.Queue(args.queue)
+    limit = asyncio.Semaphore(args.concurrency)
+
+    writer = asyncio.ensure_future(write_pages(queue, args))
+    await asyncio.gather(*(dump_chat(chat, args, limit, queue) for chat in chats))
+    await queue.put((None, None, None))
+    await writer
+
+    for chat in chats:
+        chat.conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Dump several telegram chats concurrently to SQLite3 databases')
+    parser.add_argument('chats', nargs='+', metavar='name[:id]', help="Database names. New databases need the channel ID after a colon.")
+    parser.add_argument('--host', default="localhost", help="telegram-cli host")
+    parser.add_argument('--port', type=int, default=4458, help="telegram-cli JSON port")
+    parser.add_argument('--step', type=int, default=100, help="Number of messages loaded per query at start")
+    parser.add_argument('--max-step', type=int, default=1000, help="Largest page size tried when requests are fast")
+    parser.add_argument('--fixed-step', action='store_true', help="Don't tune the page size from request latency")
+    parser.add_argument('--batch', type=int, default=5000, help="Number of messages per transaction")
+    parser.add_argument('--checkpoint', type=float, default=30.0, help="Seconds between commits and offset checkpoints of a chat")
+    parser.add_argument('--concurrency', type=int, default=4, help="Maximum number of requests in flight")
+    parser.add_argument('--queue', type=int, default=16, help="Maximum number of pages waiting for the writer")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Request timeout in seconds")
+    parser.add_argument('--backoff', type=float, default=0.5, help="First retry delay in seconds, doubled on each failure")
+    parser.add_argument('--retries', type=int, default=8, help="Consecutive failures before giving up a chat")
+    parser.add_argument('--journal', default="WAL", help="SQLite journal mode")
+    parser.add_argument('--synchronous', default="NORMAL", choices=["OFF", "NORMAL", "FULL"], help="SQLite synchronous setting")
+    parser.add_argument('--continue', dest='continue_dump', action='store_true', help="Continue dumping after interrupt")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    try:
+        chats = [open_chat(spec, args.journal, args.synchronous, args.continue_dump) for spec in args.chats]
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    for chat in chats:
+        print("%s: ID %s, offset %d" % (chat.name, chat.channel_id, chat.offset))
+
+    asyncio.run(dump(chats, args))
+
+    for chat in chats:
+        print("%s: %d new messages, offset %d" % (chat.name, chat.added, chat.committed))
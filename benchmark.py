@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import argparse, sys, os
+import sqlite3, json, time, random, datetime
+import subprocess, asyncio
+import db
+
+
+FIRST_NAMES = ["Matti", "Teemu", "Antti", "Jussi", "Mikko", "Ville", "Juha", "Anna", "Laura", "Emilia",
+               "Sanna", "Henna", "Tuomas", "Olli", "Petri", "Riikka", "Kalle", "Aino", "Eero", "Jenni"]
+LAST_NAMES = ["Virtanen", "Korhonen", "Mäkinen", "Nieminen", "Mäkelä", "Hämäläinen", "Laine", "Heikkinen",
+              "Koskinen", "Järvinen", "Lehtonen", "Saarinen", "Ääritalo", "Öhman"]
+BOTS = ["Quiz_Bot", "Weather_Bot", "Memes_bot"]
+COMMANDS = ["/start", "/help", "/weather", "/quiz", "/stats", "/meme", "/roll", "/top"]
+WORDS = ["moi", "terve", "kiitos", "joo", "ei", "no", "niin", "mutta", "että", "kun", "tänään", "huomenna",
+         "hyvää", "päivää", "äijä", "öljy", "sauna", "kahvi", "olut", "koodi", "bugi", "kokous", "lounas",
+         "mennäänkö", "syömään", "mitä", "kuuluu", "täällä", "sää", "kylmä", "lämmin", "viikonloppu",
+         "ok", "jes", "haha", "lol", "ehkä", "varmaan", "kyllä", "älä", "höpsis", "pöytä", "yö"]
+EMOJIS = [u"\U0001F600", u"\U0001F602", u"\U0001F44D", u"\U0001F389", u"\U0001F37A", u"\U0001F60E",
+          u"\U0001F680", u"☕", u"❤", u"☀", u"⚡", u"✅"]
+MEDIA = ["photo", "photo", "photo", "document", "document", "geo", "contact"]
+
+
+def peer(peer_id, print_name, peer_type="user"):
+    names = print_name.split("_")
+    return {
+        "id": "$%032x" % peer_id,
+        "peer_type": peer_type,
+        "peer_id": peer_id,
+        "print_name": print_name,
+        "first_name": names[0],
+        "last_name": names[-1] if len(names) > 1 else "",
+    }
+
+
+def synthetic_messages(rows, seed=1, users=200, end=None, interval=90, chat=0):
+    """
+        Yield synthetic messages in the shape telegram-cli returns them, newest first like sender.history.
+        Timestamps are walked backwards from `end` so no history needs to be kept in memory.
+    """
+
+    rand = random.Random(seed)
+
+    channel = {"id": "$%032x" % (0xc4a7 + chat), "peer_type": "channel", "peer_id": 0xc4a7 + chat,
+               "print_name": "Benchmark_Chat_%d" % chat if chat else "Benchmark_Chat", "title": "Benchmark Chat"}
+    people = [peer(i + 1, "%s_%s" % (rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES))) for i in range(users)]
+    bots = [peer(10000 + i, name) for i, name in enumerate(BOTS)]
+
+    # Zipf like activity: few users write most of the messages
+    weights = [1.0 / (i + 1) for i in range(users)]
+
+    timestamp = end if end is not None else int(time.time())
+    for i in reversed(range(rows)):
+
+        # Bursty traffic with quiet nights
+        hour = datetime.datetime.fromtimestamp(timestamp).hour
+        timestamp -= int(rand.expovariate(1.0 / (interval * (4 if hour < 7 else 1))))
+
+        sender = rand.choices(people, weights)[0]
+        msg = {
+            "event": "message",
+            "id": "%048x" % ((chat << 32) + 0x10000000 + i),
+            "flags": 257,
+            "date": timestamp,
+            "from": sender,
+            "to": channel,
+            "out": False,
+            "unread": False,
+            "service": False,
+        }
+
+        r = rand.random()
+        if r < 0.03:
+            action = rand.choice(["chat_add_user", "chat_add_user", "chat_add_user_link", "chat_del_user", "chat_rename"])
+            msg["event"] = "service"
+            msg["service"] = True
+            msg["action"] = {"type": action}
+            if action == "chat_rename":
+                msg["action"]["title"] = " ".join(rand.choice(WORDS) for _ in range(3)).capitalize()
+            elif action == "chat_del_user":
+                msg["action"]["user"] = rand.choice(people)
+            else:
+                msg["action"]["user"] = rand.choice(people)
+                msg["from"] = rand.choice(people) if action == "chat_add_user" else msg["action"]["user"]
+
+        elif r < 0.06:
+            msg["text"] = "%s@%s %s" % (rand.choice(COMMANDS), rand.choice(BOTS), rand.choice(WORDS))
+
+        elif r < 0.08:
+            msg["from"] = rand.choice(bots)
+            msg["text"] = " ".join(rand.choice(WORDS) for _ in range(rand.randint(3, 15)))
+
+        elif r < 0.18:
+            msg["media"] = {"type": rand.choice(MEDIA)}
+            if msg["media"]["type"] == "geo":
+                msg["media"].update({"longitude": 24.83 + rand.random(), "latitude": 60.18 + rand.random()})
+
+        else:
+            text = [rand.choice(WORDS) for _ in range(int(rand.paretovariate(1.5) * 3))]
+            if rand.random() < 0.2:
+                text.insert(rand.randint(0, len(text)), rand.choice(EMOJIS) * rand.randint(1, 3))
+            if rand.random() < 0.05:
+                text.insert(0, "@" + rand.choice(people)["print_name"])
+            msg["text"] = " ".join(text).capitalize()
+
+        yield msg
+
+
+def create_database(name, rows, seed=1):
+    """
+        Create "name.db" with synthetic messages inserted like dump.py does
+    """
+
+    print("Creating %s.db with %d messages..." % (name, rows))
+    if os.path.exists("%s.db" % name):
+        os.remove("%s.db" % name)
+
+    conn = sqlite3.connect("%s.db" % name)
+    db.configure(conn, "WAL", "OFF")
+    c = conn.cursor()
+    db.create_tables(c)
+
+    page = []
+    for msg in synthetic_messages(rows, seed):
+        page.append(msg)
+        if len(page) == 10000:
+            db.insert_messages(c, page)
+            page = []
+    db.insert_messages(c, page)
+    conn.commit()
+    conn.close()
+
+
+def timed(function, *args, repeat=1, **kwargs):
+    """
+        Return best wall time of the function call over the repeats
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_functions(name, repeat=1):
+    """
+        Time each statistic function of generate.py
+    """
+
+    import generate
+
+    generate.conn = sqlite3.connect("%s.db" % name)
+    generate.c = generate.conn.cursor()
+
+    timings = {}
+    for function in [generate.chat_renames, generate.talker_stats, generate.bot_spammers,
+                     generate.most_commonly_used_words, generate.hourly_rate, generate.popular_emojis]:
+        timings[function.__name__] = timed(function, repeat=repeat)
+
+    texts = [text for text, in generate.c.execute("SELECT text FROM messages WHERE text IS NOT NULL;")]
+    timings["tokenize"] = timed(lambda: [generate.tokenizer.tokenize(text) for text in texts], repeat=repeat)
+
+    # Per-day and per-hour series of 10M messages over five years, without the loading
+    import numpy as np
+    timestamps = np.sort(np.random.default_rng(1).integers(1400000000, 1400000000 + 5 * 365 * 86400, 10000000))
+    timings["graph_series_10M"] = timed(lambda: (generate.MessagesPerDay().count(timestamps), generate.HourlyActivity().count(timestamps)), repeat=repeat)
+
+    timings["graph_data"] = timed(lambda: generate.scan([generate.Population(), generate.MessagesPerDay(), generate.HourlyActivity()]), repeat=repeat)
+
+    population, messages, activity = generate.scan([generate.Population(), generate.MessagesPerDay(), generate.HourlyActivity()])
+    os.makedirs(name, exist_ok=True)
+    for function, data in [(generate.population_graph, population), (generate.messages_graph, messages),
+                           (generate.activity_graph, activity)]:
+        timings[function.__name__] = timed(function, data, "%s/%s.png" % (name, function.__name__), repeat=repeat)
+
+    generate.conn.close()
+    return timings
+
+
+def benchmark_sample(name, rate, method="stratified", repeat=1):
+    """
+        Compare counts estimated from a sample with the exact ones. Returns
+        (timings, accuracy) where accuracy has the median relative error of
+        each kind of count and the share of exact counts inside the 95%
+        confidence intervals. Word counts have no interval.
+    """
+
+    import generate
+
+    generate.conn = sqlite3.connect("%s.db" % name)
+    generate.c = generate.conn.cursor()
+    until = generate.c.execute("SELECT MAX(rowid) FROM messages;").fetchone()[0]
+
+    def statistics():
+        return [generate.MessagesPerDay(), generate.HourlyActivity(), generate.UserDaily(),
+                generate.BotSpammers(), generate.PopularEmojis(), generate.CommonWords()]
+
+    def counts(results, totals):
+        messages, activity, daily, bots, emojis, words = results
+        return {
+            "days": {date.isoformat(): count for date, count in messages.items()},
+            "hours": dict(enumerate(activity)),
+            "talkers": {user: counts[0] for user, counts in totals},
+            "talker_words": {user: counts[1] for user, counts in totals},
+            "bots": dict(bots[1]),
+            "emojis": dict(emojis),
+            "words": dict(words),
+        }
+
+    timings = {"sample_exact": timed(lambda: generate.scan(statistics(), until), repeat=repeat)}
+    stats = statistics()
+    exact = counts(generate.scan(stats, until), stats[2].totals())
+
+    def sampled():
+        generate.sample_messages(rate, until, method)
+        return generate.scan_sample(statistics() + [generate.EmojiSquares()], until)
+    timings["sample_%g" % rate] = timed(sampled, repeat=repeat)
+
+    labels = ["messages", "activity", "daily", "bots", "emojis", "words"]
+    generate.sample_messages(rate, until, method)
+    stats, squares = statistics(), generate.EmojiSquares()
+    scaled = generate.scale_results(dict(zip(labels, generate.scan_sample(stats + [squares], until))), rate, squares)
+    estimates = counts([scaled[label] for label in labels],
+                       [(user, [generate.scale_count(count, rate) for count in values]) for user, values in stats[2].totals()])
+
+    def error(kind, item):
+        if kind == "emojis":
+            return scaled["emojis_errors"][item]
+        return generate.sample_error(estimates[kind][item] * rate, rate)
+
+    # Items missing from the estimated top lists are estimated as zero
+    accuracy = {}
+    for kind, values in exact.items():
+        errors = sorted(abs(estimates[kind].get(item, 0) - count) / count for item, count in values.items() if count)
+        accuracy[kind] = {"median_error": errors[len(errors) // 2] if errors else 0.0, "coverage": None}
+        if kind not in ["words", "talker_words"]:
+            inside = [abs(estimates[kind][item] - count) <= error(kind, item) for item, count in values.items() if item in estimates[kind]]
+            accuracy[kind]["coverage"] = sum(inside) / len(inside) if inside else 1.0
+
+    generate.conn.close()
+    return timings, accuracy
+
+
+def benchmark_report(name, repeat=1, options=()):
+    """
+        Time the full report generation as a separate process
+    """
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate.py"), name, "--rebuild", "--cache-size", "0"] + list(options)
+    return timed(subprocess.run, command, repeat=repeat, stdout=subprocess.DEVNULL)
+
+
+async def fake_telegram(chats, host="127.0.0.1", port=0, latency=0.0, failure_rate=0.0, seed=1):
+    """
+        Serve the "history" command of telegram-cli's JSON port for the given
+        {channel id: messages newest first}. Requests take `latency` seconds
+        and a `failure_rate` share of them is dropped without an answer.
+    """
+
+    rand = random.Random(seed)
+
+    async def handle(reader, writer):
+        command = (await reader.readline()).decode().split()
+        await asyncio.sleep(latency)
+
+        if rand.random() < failure_rate:
+            writer.close()
+            return
+
+        if len(command) == 4 and command[0] == "history" and command[1] in chats:
+            offset, limit = int(command[3]), int(command[2])
+            answer = chats[command[1]][offset:offset + limit]
+        else:
+            answer = {"result": "FAIL", "error_code": 71, "error": "RPC_CALL_FAIL 6: Invalid peer"}
+
+        data = json.dumps(answer).encode()
+        writer.write(b"ANSWER %d\n" % len(data) + data + b"\n\n")
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def benchmark_dump(rows, chats=4, latency=0.02, failure_rate=0.05, concurrency=(1, 4)):
+    """
+        Time asyncdump.py dumping synthetic chats from a fake telegram-cli
+        with different concurrency limits. Checks that every message is stored.
+    """
+
+    import asyncdump
+
+    history = {}
+    for chat in range(1, chats + 1):
+        messages = list(synthetic_messages(rows // chats, chat, chat=chat))
+        history[messages[0]["to"]["id"]] = messages
+
+    async def run(limit):
+        server = await fake_telegram(history, latency=latency, failure_rate=failure_rate)
+        args = asyncdump.parse_args(["--port", "%d" % server.sockets[0].getsockname()[1], "--concurrency", "%d" % limit,
+                                     "--backoff", "0.01", "--retries", "20", "--synchronous", "OFF"] +
+                                    ["bench_dump_%d:%s" % (i, channel_id[1:]) for i, channel_id in enumerate(history)])
+        for i in range(len(history)):
+            for suffix in [".db", ".db-wal", ".db-shm", "_offset"]:
+                if os.path.exists("bench_dump_%d%s" % (i, suffix)):
+                    os.remove("bench_dump_%d%s" % (i, suffix))
+        dumped = [asyncdump.open_chat(spec, args.journal, args.synchronous) for spec in args.chats]
+        await asyncdump.dump(dumped, args)
+        server.close()
+        await server.wait_closed()
+        return sum(chat.added for chat in dumped)
+
+    timings = {}
+    for limit in concurrency:
+        start = time.perf_counter()
+        added = asyncio.run(run(limit))
+        timings["dump_concurrency_%d" % limit] = time.perf_counter() - start
+        if added != sum(map(len, history.values())):
+            print("Dumped %d messages out of %d!" % (added, sum(map(len, history.values()))))
+    return timings
+
+
+def benchmark_startup(name, repeat=1):
+    """
+        Time interpreter startup with the generate.py imports and a text only report
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return {
+        "startup_import": timed(subprocess.run, [sys.executable, "-c", "import generate"], cwd=directory, repeat=repeat),
+        "startup_text_report": timed(subprocess.run, [sys.executable, os.path.join(directory, "generate.py"), name,
+            "--no-population", "--no-messages", "--no-activity", "--cache-size", "0"], repeat=repeat, stdout=subprocess.DEVNULL),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(result, previous, threshold=10.0):
+    """
+        Print timings side by side with the previous run of the same size.
+        Slowdowns over threshold percent and 5 ms are marked as regressions.
+    """
+
+    print("\n%-28s %10s %10s %8s" % ("Benchmark", "Previous", "Current", "Change"))
+    for key, elapsed in result["timings"].items():
+        before = previous["timings"].get(key)
+        if before is None:
+            print("%-28s %10s %10.3f" % (key, "-", elapsed))
+            continue
+        change = 100.0 * (elapsed - before) / before if before else 0.0
+        print("%-28s %10.3f %10.3f %+7.1f%%%s" % (key, before, elapsed, change, "  REGRESSION" if change > threshold and elapsed - before > 0.005 else ""))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark tgstats with synthetic Telegram history')
+    parser.add_argument('--rows', type=int, default=100000, help="Number of synthetic messages (10k-10M)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed of the synthetic history")
+    parser.add_argument('--name', default=None, help="Database name (default: bench_ROWS)")
+    parser.add_argument('--regenerate', action='store_true', help="Recreate the database even if it exists")
+    parser.add_argument('--repeat', type=int, default=1, help="Repeat each measurement and keep the best")
+    parser.add_argument('--no-functions', action='store_true', help="Don't time the individual functions")
+    parser.add_argument('--no-report', action='store_true', help="Don't time the full report")
+    parser.add_argument('--dump', action='store_true', help="Also time asyncdump.py against a fake telegram-cli")
+    parser.add_argument('--dump-chats', type=int, default=4, help="Number of chats served by the fake telegram-cli")
+    parser.add_argument('--sample', type=float, metavar='RATE', help="Also validate reports estimated from a sample of RATE of the messages")
+    parser.add_argument('--sample-method', default="stratified", choices=["stratified", "uniform"], help="Sampling method validated with --sample")
+    parser.add_argument('--results', default="benchmarks.jsonl", help="File where results are appended")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Slowdown in percent reported as a regression")
+    args = parser.parse_args()
+
+    name = args.name or "bench_%d" % args.rows
+
+    if args.regenerate or not os.path.exists("%s.db" % name):
+        timing = timed(create_database, name, args.rows, args.seed)
+        print("Created in %.1f s" % timing)
+
+    result = {
+        "date": datetime.datetime.now().isoformat(),
+        "revision": git_revision(),
+        "rows": args.rows,
+        "seed": args.seed,
+        "timings": {},
+    }
+
+    if not args.no_functions:
+        result["timings"].update(benchmark_functions(name, args.repeat))
+    if not args.no_report:
+        result["timings"]["report"] = benchmark_report(name, args.repeat)
+        result["timings"].update(benchmark_startup(name, args.repeat))
+    if args.dump:
+        result["timings"].update(benchmark_dump(args.rows, args.dump_chats))
+    if args.sample:
+        timings, result["sample"] = benchmark_sample(name, args.sample, args.sample_method, args.repeat)
+        result["timings"].update(timings)
+
+        print("\n%-28s %12s %10s" % ("Estimate (%g %s)" % (args.sample, args.sample_method), "Median error", "Coverage"))
+        for kind, accuracy in result["sample"].items():
+            print("%-28s %11.1f%% %10s" % (kind, 100.0 * accuracy["median_error"],
+                "-" if accuracy["coverage"] is None else "%.1f%%" % (100.0 * accuracy["coverage"])))
+
+    # Compare with the previous run of the same corpus
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            for line in f:
+                run = json.loads(line)
+                if run["rows"] == args.rows and run["seed"] == args.seed:
+                    previous = run
+
+    if previous:
+        compare(result, previous, args.threshold)
+    else:
+        print("\n%-28s %10s" % ("Benchmark", "Time (s)"))
+        for key, elapsed in result["timings"].items():
+            print("%-28s %10.3f" % (key, elapsed))
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import argparse, sys, os
+import sqlite3, time, random
+import db
+
+
+def database_size(name):
+    """
+        Return size of "name.db" and its WAL file in bytes
+    """
+
+    return sum(os.path.getsize(path) for path in ["%s.db" % name, "%s.db-wal" % name] if os.path.exists(path))
+
+
+def scan_speed(c, codec):
+    """
+        Read and decode every json payload. Returns (rows, seconds).
+    """
+
+    start = time.perf_counter()
+    rows = 0
+    for value, in c.execute("SELECT json FROM messages;"):
+        db.load_json(value, codec)
+        rows += 1
+    return rows, time.perf_counter() - start
+
+
+def report(name, c, codec, label):
+    rows, elapsed = scan_speed(c, codec)
+    size = database_size(name)
+    print("%-7s %8.1f MB %8d rows %8.2f s %10.0f rows/s" % (label, size / 1e6, rows, elapsed, rows / elapsed if elapsed else 0))
+    return size
+
+
+def sample_payloads(c, codec, samples):
+    """
+        Return json text of randomly chosen messages
+    """
+
+    rowids = [rowid for rowid, in c.execute("SELECT rowid FROM messages;")]
+    rowids = random.Random(1).sample(rowids, min(samples, len(rowids)))
+    return [db.json_text(c.execute("SELECT json FROM messages WHERE rowid = ?;", (rowid, )).fetchone()[0], codec)
+            for rowid in rowids]
+
+
+def rewrite(conn, old, new, batch=10000):
+    """
+        Re-encode the json column from codec old to codec new (None is plain text)
+    """
+
+    c = conn.cursor()
+    last, total = 0, 0
+    while True:
+        rows = c.execute("SELECT rowid, json FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?;", (last, batch)).fetchall()
+        if not rows:
+            break
+        c.executemany("UPDATE messages SET json = ? WHERE rowid = ?;", [
+            (new.encode(text) if new else text, rowid)
+            for rowid, text in ((rowid, db.json_text(value, old)) for rowid, value in rows)])
+        last = rows[-1][0]
+        total += len(rows)
+        print("Converted", total)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compress the json column of a tgstats database with a trained zstd dictionary')
+    parser.add_argument('name', type=str, help="Database name")
+    parser.add_argument('--level', type=int, default=9, help="Compression level used for converting")
+    parser.add_argument('--samples', type=int, default=20000, help="Number of messages used for training the dictionary")
+    parser.add_argument('--dict-size', type=int, default=112640, help="Dictionary size in bytes")
+    parser.add_argument('--decompress', action='store_true', help="Convert back to plain json text")
+    args = parser.parse_args()
+
+    if not os.path.exists("%s.db" % args.name):
+        print("No such database %s.db" % args.name)
+        sys.exit(1)
+
+    conn = sqlite3.connect("%s.db" % args.name)
+    c = conn.cursor()
+
+    try:
+        old = db.load_codec(c)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+
+    before = report(args.name, c, old, "Before")
+
+    if args.decompress:
+        new = None
+    else:
+        print("Training dictionary from %d messages..." % args.samples)
+        try:
+            new = db.train_codec(sample_payloads(c, old, args.samples), args.dict_size, args.level)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+
+    rewrite(conn, old, new)
+    db.save_codec(c, new)
+    conn.commit()
+
+    print("Vacuuming...")
+    c.execute("VACUUM;")
+    c.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+    after = report(args.name, c, new, "After")
+    print("Size %.1f%% of the original" % (100.0 * after / before))
+    conn.close()
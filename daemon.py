@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse, sys, os
+import sqlite3, json, time, queue, threading
+import db, export, generate
+
+
+def receive(messages, host, port):
+    """
+        Pass messages pushed by telegram-cli to the queue. Runs in a thread.
+    """
+
+    from pytg.receiver import Receiver
+    from pytg.utils import coroutine
+
+    @coroutine
+    def forward():
+        while True:
+            messages.put((yield))
+
+    receiver = Receiver(host=host, port=port)
+    receiver.start()
+    try:
+        receiver.message(forward())
+    finally:
+        receiver.stop()
+        messages.put(None)
+
+
+def replay(messages, path, rate=0):
+    """
+        Pass the messages of an export to the queue, `rate` messages per
+        second or as fast as they are handled. Runs in a thread.
+    """
+
+    try:
+        for row in export.read_export(path, ["json"]):
+            messages.put(json.loads(row["json"]))
+            if rate:
+                time.sleep(1.0 / rate)
+    finally:
+        messages.put(None)
+
+
+class LiveReport:
+    """
+        Report whose statistics are kept in memory and updated with every
+        new message. Statistics are persisted and the page is written when
+        update() is called, reusing the unchanged sections and graphs.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+        # The statistics run inside generate.py's module state
+        generate.conn = self.conn = sqlite3.connect("%s.db" % name, timeout=db.BUSY_TIMEOUT)
+        generate.c = self.c = self.conn.cursor()
+        generate.tokenizer = generate.Tokenizer(args.alphabet)
+        generate.timezone = args.timezone
+        db.configure(self.conn)
+        if not self.c.execute("SELECT name FROM sqlite_master WHERE name = 'messages';").fetchone():
+            print("Creating tables..")
+            db.create_tables(self.c)
+            self.conn.commit()
+        self.codec = db.load_codec(self.c)
+
+        try:
+            os.mkdir(name)
+        except OSError:
+            pass
+        self.cache = generate.FragmentCache("%s/.cache" % name, args.cache_size * 1024) if args.cache_size else None
+
+        # Catch up with the messages dumped since the previous run
+        self.accumulators = generate.report_statistics(args)
+        generate.restore(self.accumulators, args.rebuild)
+        until = self.c.execute("SELECT IFNULL(MAX(rowid), 0) FROM messages;").fetchone()[0]
+        print("Scanning messages...")
+        # The daemon stores messages itself, so it has to get the lock anyway
+        db.update_users(self.c, min(stat.since for stat in self.accumulators.values()))
+        self.conn.commit()
+        generate.scan(list(self.accumulators.values()), until, users=False)
+
+        # Query statistics are fed row by row from now on
+        self.stats = [generate.QueryRows(stat) if stat.query else stat for stat in self.accumulators.values()]
+        self.added = 0
+
+    def add(self, msgs):
+        """
+            Insert messages and add the new ones to the statistics. Returns number of new messages.
+        """
+
+        names = [name for name, _ in db.COLUMNS]
+        rows = []
+        for msg in msgs:
+            if db.insert_messages(self.c, [msg], self.codec):
+                row = dict(zip(names, db.message_columns(msg)))
+                row["rowid"] = self.c.execute("SELECT last_insert_rowid();").fetchone()[0]
+                row["timestamp"] = msg["date"]
+                row["event"] = msg["event"]
+                db.add_users(self.c, [(row["from_id"], row["from_name"], row["timestamp"])])
+                row["from_key"], row["from_bot"] = db.user_key(self.c, row["from_id"])
+                rows.append(row)
+
+        generate.dispatch(self.stats, rows)
+        self.added += len(rows)
+        return len(rows)
+
+    def update(self):
+        """
+            Commit the new messages, persist the statistics and rewrite the changed parts of the report
+        """
+
+        self.conn.commit()
+        results = dict(zip(self.accumulators.keys(), [stat.result() for stat in self.stats]))
+
+        until = self.c.execute("SELECT IFNULL(MAX(rowid), 0) FROM messages;").fetchone()[0]
+        skipped = generate.persist(self.accumulators, until)
+
+        # Stored rollups are summed by the talker queries, only new ones are kept in memory.
+        # If the database was locked they are kept until the next update.
+        daily = self.accumulators.get("daily")
+        totals = generate.rollup_totals
+        if daily and skipped is None:
+            totals = generate.pending_totals(daily, daily.since > 0)
+        elif daily and "daily" not in skipped:
+            daily.days = {}
+
+        generate.write_report(self.name, self.args, self.accumulators, results, totals,
+            db.user_names(self.c), cache=self.cache, jobs=self.args.jobs)
+
+    def close(self):
+        self.conn.close()
+
+
+def run(report, messages, channel_id=None, debounce=2.0, max_delay=10.0, batch=1000):
+    """
+        Add messages from the queue to the report until None is received.
+        The report is updated when no messages have arrived for `debounce`
+        seconds, or at the latest `max_delay` seconds after the first change.
+    """
+
+    first = last = None
+    while True:
+        # Checked before reading as the queue may never run empty
+        if first is not None and time.time() >= min(last + debounce, first + max_delay):
+            report.update()
+            print("Updated report %.2f s after the first new message" % (time.time() - first))
+            first = None
+
+        timeout = None if first is None else max(0, min(last + debounce, first + max_delay) - time.time())
+        try:
+            msgs = [messages.get(timeout=timeout)]
+        except queue.Empty:
+            continue
+
+        # Handle the messages waiting in the queue together
+        while msgs[-1] is not None and len(msgs) < batch:
+            try:
+                msgs.append(messages.get_nowait())
+            except queue.Empty:
+                break
+        done = msgs[-1] is None
+
+        msgs = [msg for msg in msgs if msg is not None and msg.get("event") in ("message", "service")
+                and (channel_id is None or (msg.get("to") or {}).get("id") == channel_id)]
+        if msgs and report.add(msgs):
+            last = time.time()
+            if first is None:
+                first = last
+
+        if done:
+            break
+
+    if first is not None:
+        report.update()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Keep the report of a chat up to date while telegram-cli receives new messages')
+    parser.add_argument('name', type=str, help="Database name")
+    generate.add_report_arguments(parser)
+    parser.add_argument('--host', default="localhost", help="telegram-cli host")
+    parser.add_argument('--port', type=int, default=4458, help="telegram-cli JSON port")
+    parser.add_argument('--replay', metavar='PATH', help="Read new messages from an export of export.py instead of telegram-cli")
+    parser.add_argument('--replay-rate', type=float, default=0, metavar='N', help="Replayed messages per second, 0 for as fast as possible")
+    parser.add_argument('--debounce', type=float, default=2.0, help="Seconds without new messages before the report is updated")
+    parser.add_argument('--max-delay', type=float, default=10.0, help="Longest time in seconds the report is left outdated")
+    parser.add_argument('--queue', type=int, default=10000, help="Maximum number of messages waiting to be added")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of processes used for rendering graphs")
+    args = parser.parse_args()
+
+    if not args.replay and not os.path.exists("%s.db" % args.name):
+        print("No such database %s.db! Dump the history first." % args.name)
+        sys.exit(1)
+
+    report = LiveReport(args.name, args)
+
+    channel_id = None
+    if not args.replay:
+        try:
+            channel_id = db.channel_id(report.c)
+        except (sqlite3.OperationalError, KeyError, ValueError, TypeError):
+            print("Failed to read channel ID! Uninitialized or empty database!")
+            sys.exit(1)
+        print("ID:", channel_id)
+
+    report.update()
+
+    messages = queue.Queue(args.queue)
+    if args.replay:
+        source = threading.Thread(target=replay, args=(messages, args.replay, args.replay_rate), daemon=True)
+    else:
+        source = threading.Thread(target=receive, args=(messages, args.host, args.port), daemon=True)
+    source.start()
+
+    print("Waiting for new messages...")
+    try:
+        run(report, messages, channel_id, args.debounce, args.max_delay)
+    except KeyboardInterrupt:
+        report.update()
+
+    print("%d new messages" % report.added)
+    report.close()
@@ -0,0 +1,385 @@
+"""
+    Database schema shared by dump.py and generate.py
+"""
+
+import json, sqlite3
+
+
+# Columns extracted from the message JSON so that statistics can be
+# queried without decoding the payload.
+COLUMNS = [
+    ("from_id", "CHAR(48)"),
+    ("from_name", "TEXT"),
+    ("text", "TEXT"),
+    ("media_type", "CHAR(16)"),
+    ("action_type", "CHAR(32)"),
+    ("action_title", "TEXT"),
+]
+
+
+# Seconds a report waits for the write lock. dump.py keeps its write
+# transaction open for up to --checkpoint (30) seconds.
+BUSY_TIMEOUT = 60.0
+
+
+# Indexes for the access paths of generate.py: statistics read a
+# timestamp range of one or two events in timestamp order, and the
+# population and topic queries pick service messages by action type.
+INDEXES = [
+    ("messages_timestamp", "timestamp"),
+    ("messages_event_timestamp", "event, timestamp"),
+    ("messages_event_action", "event, action_type, timestamp"),
+]
+
+
+def create_tables(c):
+    """
+        Create messages table and its indexes
+    """
+
+    # ID on 48 merkkiäpitkä hexa
+    c.execute('''CREATE TABLE messages (id CHAR(48), timestamp INTEGER, json TEXT, event CHAR(16), %s);''' %
+        ", ".join("%s %s" % col for col in COLUMNS))
+    c.execute('''CREATE UNIQUE INDEX messages_id ON messages (id);''')
+    create_indexes(c)
+
+
+def create_indexes(c):
+    """
+        Create missing query indexes of the messages table
+    """
+
+    for name, columns in INDEXES:
+        c.execute("CREATE INDEX IF NOT EXISTS %s ON messages (%s);" % (name, columns))
+
+
+def message_columns(msg):
+    """
+        Extract values for the normalized columns from a message dict
+    """
+
+    sender = msg.get("from") or {}
+    media = msg.get("media") or {}
+    action = msg.get("action") or {}
+
+    return (
+        sender.get("id"),
+        sender.get("print_name"),
+        msg.get("text"),
+        media.get("type"),
+        action.get("type"),
+        action.get("title"),
+    )
+
+
+def insert_message(c, msg, codec=None):
+    """
+        Insert a message received from telegram-cli
+    """
+
+    c.execute("INSERT INTO messages (id, timestamp, json, event, %s) VALUES (?, ?, ?, ?, %s)" % (
+        ", ".join(name for name, _ in COLUMNS), ", ".join("?" * len(COLUMNS))),
+        (msg["id"], msg["date"], dump_json(msg, codec), msg["event"]) + message_columns(msg))
+
+
+def insert_messages(c, msgs, codec=None):
+    """
+        Insert a page of messages skipping already stored ones. Returns number of new messages.
+    """
+
+    c.executemany("INSERT OR IGNORE INTO messages (id, timestamp, json, event, %s) VALUES (?, ?, ?, ?, %s)" % (
+        ", ".join(name for name, _ in COLUMNS), ", ".join("?" * len(COLUMNS))),
+        [(msg["id"], msg["date"], dump_json(msg, codec), msg["event"]) + message_columns(msg) for msg in msgs])
+    return max(c.rowcount, 0)
+
+
+def zstd():
+    """
+        Import zstandard, which is needed only for compressed databases
+    """
+
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("Compressed databases need zstandard: pip3 install zstandard")
+    return zstandard
+
+
+class Codec:
+    """
+        Zstandard compression of the json column. Messages share most of
+        their keys and peer objects, so a dictionary trained from the
+        messages of the database compresses even single rows well.
+    """
+
+    def __init__(self, dictionary, level=3):
+        zstandard = zstd()
+        self.dictionary = dictionary
+        data = zstandard.ZstdCompressionDict(dictionary)
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=data)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=data)
+
+    def encode(self, text):
+        return self.compressor.compress(text.encode())
+
+    def decode(self, data):
+        return self.decompressor.decompress(data).decode()
+
+
+def train_codec(payloads, size=112640, level=3):
+    """
+        Train a Codec from sample json payloads
+    """
+
+    return Codec(zstd().train_dictionary(size, [payload.encode() for payload in payloads]).as_bytes(), level)
+
+
+def load_codec(c, level=3):
+    """
+        Return the Codec of a compressed database or None
+    """
+
+    try:
+        row = c.execute("SELECT data FROM dictionaries ORDER BY id DESC LIMIT 1;").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return Codec(row[0], level) if row else None
+
+
+def save_codec(c, codec):
+    """
+        Store the dictionary of the codec, or remove it when codec is None
+    """
+
+    c.execute("CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, data BLOB);")
+    c.execute("DELETE FROM dictionaries;")
+    if codec is not None:
+        c.execute("INSERT INTO dictionaries (data) VALUES (?);", (codec.dictionary, ))
+
+
+def dump_json(msg, codec=None):
+    """
+        Return the json column value of a message
+    """
+
+    text = json.dumps(msg)
+    return codec.encode(text) if codec else text
+
+
+def json_text(value, codec=None):
+    """
+        Return the json text of a json column value. Compressed values are blobs.
+    """
+
+    return codec.decode(value) if isinstance(value, bytes) else value
+
+
+def load_json(value, codec=None):
+    """
+        Decode a json column value, compressed or not
+    """
+
+    return json.loads(json_text(value, codec))
+
+
+def channel_id(c):
+    """
+        Return the id of the chat the database contains, read from its first message
+    """
+
+    c.execute("SELECT json FROM messages LIMIT 1;")
+    return load_json(c.fetchone()[0], load_codec(c))["to"]["id"]
+
+
+def configure(conn, journal="WAL", synchronous="NORMAL"):
+    """
+        Set journal mode and synchronous level for dumping
+    """
+
+    conn.execute("PRAGMA journal_mode = %s;" % journal)
+    conn.execute("PRAGMA synchronous = %s;" % synchronous)
+
+
+def missing_columns(c):
+    """
+        Return names of the normalized columns missing from the messages table
+    """
+
+    existing = [row[1] for row in c.execute("PRAGMA table_info(messages);")]
+    return [name for name, _ in COLUMNS if name not in existing]
+
+
+def missing_indexes(c):
+    """
+        Return names of the query indexes missing from the messages table
+    """
+
+    existing = [row[1] for row in c.execute("PRAGMA index_list(messages);")]
+    return [name for name, _ in INDEXES if name not in existing]
+
+
+def migrate(conn, batch=10000):
+    """
+        Add missing columns and indexes to an old database and backfill the columns from the json column
+    """
+
+    c = conn.cursor()
+
+    for name, decl in COLUMNS:
+        if name in missing_columns(c):
+            print("Adding column", name)
+            c.execute("ALTER TABLE messages ADD COLUMN %s %s;" % (name, decl))
+
+    print("Backfilling columns...")
+    assignments = ", ".join("%s = ?" % name for name, _ in COLUMNS)
+    codec = load_codec(c)
+
+    last, total = 0, 0
+    while True:
+        rows = c.execute("SELECT rowid, json FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?;", (last, batch)).fetchall()
+        if not rows:
+            break
+        c.executemany("UPDATE messages SET %s WHERE rowid = ?;" % assignments,
+            [message_columns(load_json(data, codec)) + (rowid, ) for rowid, data in rows])
+        last = rows[-1][0]
+        total += len(rows)
+        print("Migrated", total)
+
+    for name in missing_indexes(c):
+        print("Creating index", name)
+    create_indexes(c)
+    c.execute("ANALYZE;")
+
+    conn.commit()
+
+
+def create_users(c, temp=False):
+    """
+        Create the user dimension table: a compact integer key for every
+        sender id with its latest display name and a bot flag. A temp table
+        shadows the stored one for the connection.
+    """
+
+    c.execute('''CREATE %sTABLE IF NOT EXISTS users (key INTEGER PRIMARY KEY, user_id CHAR(48) UNIQUE,
+                 name TEXT, bot INTEGER, seen INTEGER);''' % ("TEMP " if temp else ""))
+
+
+def is_bot(name):
+    """
+        Bot usernames have to end with "bot"
+    """
+
+    return name is not None and name.lower().endswith("bot")
+
+
+def add_users(c, senders):
+    """
+        Add list of (id, print_name, timestamp) to the users table. A name
+        replaces the stored one only if it was seen later.
+    """
+
+    c.executemany('''INSERT INTO users (user_id, name, bot, seen) VALUES (?, ?, ?, ?)
+                     ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, bot = excluded.bot, seen = excluded.seen
+                     WHERE excluded.seen >= users.seen;''',
+        [(user_id, name, is_bot(name), timestamp) for user_id, name, timestamp in senders if user_id is not None])
+
+
+def new_senders(c, since=0):
+    """
+        Return list of (id, print_name, timestamp) of the senders of the
+        messages after rowid `since` which are missing from the users table
+        or were seen later with maybe another name
+    """
+
+    return c.execute('''SELECT senders.* FROM (SELECT from_id, from_name, MAX(timestamp) AS seen FROM messages
+                         WHERE rowid > ? GROUP BY from_id) AS senders LEFT JOIN users ON users.user_id = senders.from_id
+                         WHERE users.user_id IS NULL OR senders.seen > users.seen;''', (since, )).fetchall()
+
+
+def update_users(c, since=0):
+    """
+        Add the senders of the messages after rowid `since` to the users
+        table. Nothing is written if they are already there.
+    """
+
+    create_users(c)
+    add_users(c, new_senders(c, since))
+
+
+def user_key(c, user_id):
+    """
+        Return (key, bot) of a sender id or (None, None)
+    """
+
+    return c.execute("SELECT key, bot FROM users WHERE user_id = ?;", (user_id, )).fetchone() or (None, None)
+
+
+def user_names(c):
+    """
+        Return dict of user key to the latest print name
+    """
+
+    return dict(c.execute("SELECT key, name FROM users;"))
+
+
+def create_aggregates(c):
+    """
+        Create table for the persisted statistics state
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS aggregates (name TEXT PRIMARY KEY, key TEXT,
+                 last_rowid INTEGER, last_timestamp INTEGER, state TEXT);''')
+
+
+def load_aggregate(c, name):
+    """
+        Return (key, last_rowid, last_timestamp, state) of a persisted statistic or None
+    """
+
+    return c.execute("SELECT key, last_rowid, last_timestamp, state FROM aggregates WHERE name = ?;", (name, )).fetchone()
+
+
+def save_aggregates(conn, aggregates):
+    """
+        Store list of (name, key, last_rowid, last_timestamp, state) tuples
+    """
+
+    conn.executemany("INSERT OR REPLACE INTO aggregates VALUES (?, ?, ?, ?, ?);", aggregates)
+    conn.commit()
+
+
+def create_rollups(c):
+    """
+        Create table of daily per-user counters
+    """
+
+    # Rollups of older versions were keyed by name. They are recomputed.
+    if "from_name" in [row[1] for row in c.execute("PRAGMA table_info(user_daily);")]:
+        c.execute("DROP TABLE user_daily;")
+
+    c.execute('''CREATE TABLE IF NOT EXISTS user_daily (day TEXT, user INTEGER,
+                 messages INTEGER, words INTEGER, stickers INTEGER, photos INTEGER,
+                 PRIMARY KEY (day, user));''')
+
+
+def add_rollups(c, rows):
+    """
+        Add list of (day, user key, messages, words, stickers, photos) to the daily counters
+    """
+
+    c.executemany('''INSERT INTO user_daily VALUES (?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (day, user) DO UPDATE SET
+                     messages = messages + excluded.messages, words = words + excluded.words,
+                     stickers = stickers + excluded.stickers, photos = photos + excluded.photos;''', rows)
+
+
+USER_TOTALS = '''SELECT user, SUM(messages), SUM(words), SUM(stickers), SUM(photos) FROM user_daily
+                 WHERE day >= ? AND day <= ? GROUP BY user;'''
+
+
+def user_totals(c, first=None, last=None):
+    """
+        Return (user key, messages, words, stickers, photos) summed over days first..last (YYYY-MM-DD, inclusive)
+    """
+
+    return c.execute(USER_TOTALS, (first or "", last or "9999-12-31")).fetchall()
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse, sys
-import sqlite3, time, json
+import sqlite3, time
 from datetime import datetime
-from pytg.exceptions import *
-from pytg.sender import Sender
-from pytg.receiver import Receiver
+from concurrent.futures import ThreadPoolExecutor
+import db
+from history import Backoff, PageSize, read_offset, write_offset
 
 
 
@@ -15,14 +15,25 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Dump telegram logs to SQLite3 database')
     parser.add_argument('name', type=str, nargs='?', default="", help="Database name")
     parser.add_argument('--id', action="store", default="", help="Channel ID (needed only with initdb!)")
-    parser.add_argument('--step', action="store", default=100, help="Number of messages loaded per query")
+    parser.add_argument('--step', action="store", type=int, default=100, help="Number of messages loaded per query at start")
+    parser.add_argument('--max-step', action="store", type=int, default=1000, help="Largest page size tried when requests are fast")
+    parser.add_argument('--fixed-step', action='store_true', help="Don't tune the page size from request latency")
+    parser.add_argument('--batch', action="store", type=int, default=5000, help="Number of messages per transaction")
+    parser.add_argument('--checkpoint', action="store", type=float, default=30.0, help="Seconds between commits and offset checkpoints")
+    parser.add_argument('--journal', action="store", default="WAL", help="SQLite journal mode")
+    parser.add_argument('--synchronous', action="store", default="NORMAL", choices=["OFF", "NORMAL", "FULL"], help="SQLite synchronous setting")
     parser.add_argument('--dialogs', action='store_true', help="List all dialogs")
     parser.add_argument('--initdb', action='store_true', help="Initalise database")
     parser.add_argument('--continue', dest='continue_dump', action='store_true', help="Continue dumping after interrup")
+    parser.add_argument('--migrate', action='store_true', help="Add normalized columns to an old database and exit")
 
     args = parser.parse_args()
 
-    sender = Sender(host="localhost", port=4458)
+    # pytg is needed only when talking to telegram-cli
+    if not args.migrate:
+        from pytg.exceptions import IllegalResponseException, NoResponse
+        from pytg.sender import Sender
+        sender = Sender(host="localhost", port=4458)
 
 
     # Dialog listing
@@ -40,15 +51,18 @@ if __name__ == "__main__":
 
     # Open the database
     conn = sqlite3.connect('%s.db' % args.name)
+    db.configure(conn, args.journal, args.synchronous)
     c = conn.cursor()
 
+    # Upgrade old database
+    if args.migrate:
+        db.migrate(conn)
+        sys.exit(0)
+
     # Init database
     if args.initdb:
         print("Creating tables..")
-        # ID on 48 merkkiäpitkä hexa
-        c.execute('''CREATE TABLE messages (id CHAR(48), timestamp INTEGER, json TEXT, event CHAR(16));''')
-        #c.execute('''CREATE TABLE users (id CHAR(48), full_name CHAR(32), json TEXT);''')
-        c.execute('''CREATE UNIQUE INDEX messages_id ON messages (id);''')
+        db.create_tables(c)
 
         # Check ID
         if len(args.id) != 32:
@@ -64,61 +78,94 @@ if __name__ == "__main__":
 
         # Get the ID from the database!
         try:
-            c.execute("SELECT json FROM messages LIMIT 1;")
-            ret = json.loads(c.fetchone()[0])
-            channel_id = ret["to"]["id"]
-        except (sqlite3.OperationalError, KeyError, ValueError):
+            channel_id = db.channel_id(c)
+        except (sqlite3.OperationalError, KeyError, ValueError, TypeError):
             print("Failed to read channel ID! Uninitialized or empty database!")
             sys.exit(1)
 
         print("ID:", channel_id)
 
 
-    if args.continue_dump:
-        try:
-            with open("%s_offset" % args.name, "r") as f:
-                offset = int(f.read()) or 0
-        except FileNotFoundError:
-            offset = 0
-    else:
-        offset = 0
+    offset = read_offset(args.name) if args.continue_dump else 0
+
+    # New messages of a compressed database are compressed too
+    codec = db.load_codec(c)
 
 
     empties = 0
+    failed = False
+    pending = 0
+    checkpointed = time.time()
     print("Offset:", offset)
 
-    while True:
+    backoff = Backoff()
+    if args.fixed_step:
+        pages = PageSize(args.step, args.step, args.step)
+    else:
+        pages = PageSize(args.step, maximum=args.max_step)
+
+    def fetch(offset, size):
+        start = time.time()
+        return sender.history(channel_id, size, offset), time.time() - start
 
-        new_messages = 0
+    # Next page is fetched in the background while the previous one is written
+    with ThreadPoolExecutor(1) as fetcher:
+        page = fetcher.submit(fetch, offset, pages.size)
 
-        try:
-            res = sender.history(channel_id, args.step, offset)
-            if "error" in res:
-                print(res)
+        while True:
+
+            try:
+                res, elapsed = page.result()
+                if "error" in res:
+                    print(res)
+                    failed = True
+                    break
+            except (IllegalResponseException, NoResponse):
+                empties += 1
+                if empties > 5:
+                    print("Too many empty responses")
+                    failed = True
+                    break
+
+                delay = backoff.failure()
+                print("Empty response, retrying in %.1f s with %d messages" % (delay, pages.failure()))
+                time.sleep(delay)
+                page = fetcher.submit(fetch, offset, pages.size)
+                continue
+
+            empties = 0
+            backoff.success()
+
+            # Beginning of the history
+            if len(res) == 0:
+                print("Reached the first message")
                 break
-        except (IllegalResponseException, NoResponse):
-            print("Empty response")
 
-            empties += 1
-            if empties > 5:
-                sys.exit(1)
+            page = fetcher.submit(fetch, offset + len(res), pages.success(elapsed))
 
-            time.sleep(2)
-            continue
+            new_messages = db.insert_messages(c, res, codec)
+            pending += len(res)
+            offset += len(res)
+            print("Added %d, collisions %d (%d messages in %.2f s)" % (new_messages, len(res) - new_messages, len(res), elapsed))
 
-        for msg in res:
-            try:
-                c.execute("INSERT INTO messages VALUES (?, ?, ?, ?)", (msg.id, msg.date, json.dumps(msg), msg.event))
+            # Offset is stored only when the rows before it are committed
+            if pending >= args.batch or time.time() - checkpointed >= args.checkpoint:
                 conn.commit()
-                print("Added", msg.id)
-                new_messages += 1
-            except sqlite3.IntegrityError:
-                print("Collision", msg.id)
-
-        offset += len(res)
-        with open("%s_offset" % args.name, "w") as f:
-            f.write("%d" % offset)
-        print("Offset", offset)
-
-        if not args.continue_dump and new_messages == 0:
-            break
+                write_offset(args.name, offset)
+                pending = 0
+                checkpointed = time.time()
+                print("Offset", offset)
+
+            # A page of only stored messages means the rest is dumped already
+            if not args.continue_dump and new_messages == 0:
+                print("Reached already dumped messages")
+                break
+
+        page.cancel()
+
+    conn.commit()
+    write_offset(args.name, offset)
+    print("Offset", offset)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import argparse, sys, os
+import sqlite3, json, gzip
+import db
+
+
+# Flattened fields of an exported message: the normalized columns and the
+# raw message json as text
+FIELDS = ["id", "timestamp", "event"] + [name for name, _ in db.COLUMNS] + ["json"]
+
+EXTENSIONS = {"jsonl": "jsonl.gz", "parquet": "parquet"}
+
+
+def arrow():
+    """
+        Import pyarrow, which is needed only for Parquet exports
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet exports need pyarrow: pip3 install pyarrow")
+    return pyarrow
+
+
+def read_chunks(c, fields, chunk, codec=None):
+    """
+        Yield lists of at most `chunk` messages as tuples of fields in
+        timestamp order. The json column is decompressed to plain text.
+    """
+
+    cursor = c.execute("SELECT %s FROM messages ORDER BY timestamp, rowid;" % ", ".join(fields))
+    payload = fields.index("json") if "json" in fields else None
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            break
+        if payload is not None and codec:
+            rows = [row[:payload] + (db.json_text(row[payload], codec), ) + row[payload + 1:] for row in rows]
+        yield rows
+
+
+def write_jsonl(path, fields, rows):
+    with gzip.open(path, "wt", encoding="utf-8") as out:
+        for row in rows:
+            out.write(json.dumps(dict(zip(fields, row)), ensure_ascii=False))
+            out.write("\n")
+
+
+def write_parquet(path, fields, rows):
+    pa = arrow()
+    schema = pa.schema([(field, pa.int64() if field == "timestamp" else pa.string()) for field in fields])
+    columns = [pa.array(values, type=schema.field(i).type) for i, values in enumerate(zip(*rows))]
+    pa.parquet.write_table(pa.Table.from_arrays(columns, schema=schema), path, compression="zstd")
+
+
+def load_manifest(path):
+    """
+        Return the manifest of the export in folder path
+    """
+
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError("No export in %s" % path)
+
+
+def export(c, path, format="jsonl", chunk=100000, fields=FIELDS):
+    """
+        Write the messages to numbered part files of at most `chunk` rows
+        and a manifest listing them. Only one chunk is held in memory.
+    """
+
+    if format == "parquet":
+        arrow()
+    write = write_parquet if format == "parquet" else write_jsonl
+    codec = db.load_codec(c)
+
+    os.makedirs(path, exist_ok=True)
+
+    # The manifest is written last, so an interrupted export is never read
+    try:
+        old = load_manifest(path)
+        os.remove(os.path.join(path, "manifest.json"))
+        for part in old["parts"]:
+            os.remove(os.path.join(path, part["file"]))
+    except (ValueError, FileNotFoundError):
+        pass
+
+    parts = []
+    for rows in read_chunks(c, fields, chunk, codec):
+        filename = "part-%05d.%s" % (len(parts), EXTENSIONS[format])
+        write(os.path.join(path, filename), fields, rows)
+        timestamps = [row[fields.index("timestamp")] for row in rows]
+        parts.append({"file": filename, "rows": len(rows), "first": timestamps[0], "last": timestamps[-1]})
+        print("Exported", sum(part["rows"] for part in parts))
+
+    manifest = {
+        "format": format,
+        "fields": fields,
+        "rows": sum(part["rows"] for part in parts),
+        "first": parts[0]["first"] if parts else None,
+        "last": parts[-1]["last"] if parts else None,
+        "parts": parts
+    }
+    with open(os.path.join(path, "manifest.json.tmp"), "w") as out:
+        json.dump(manifest, out, indent=1)
+    os.replace(os.path.join(path, "manifest.json.tmp"), os.path.join(path, "manifest.json"))
+    return manifest
+
+
+def read_export(path, fields=None, batch=65536):
+    """
+        Yield the messages of an export as dicts in timestamp order. Parts
+        are read one at a time, Parquet parts memory mapped in batches of
+        only the requested fields.
+    """
+
+    manifest = load_manifest(path)
+    for part in manifest["parts"]:
+        filepath = os.path.join(path, part["file"])
+        if manifest["format"] == "parquet":
+            parquet = arrow().parquet.ParquetFile(filepath, memory_map=True)
+            for rows in parquet.iter_batches(batch_size=batch, columns=fields):
+                yield from rows.to_pylist()
+        else:
+            with gzip.open(filepath, "rt", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+def import_export(path, conn, batch=10000):
+    """
+        Insert the messages of an export into a database with empty tables. Returns number of messages.
+    """
+
+    manifest = load_manifest(path)
+    if "json" not in manifest["fields"]:
+        raise ValueError("Export %s has no message json and can't be imported" % path)
+
+    c = conn.cursor()
+    query = "INSERT OR IGNORE INTO messages (%s) VALUES (%s)" % (", ".join(FIELDS), ", ".join("?" * len(FIELDS)))
+
+    rows, total = [], 0
+    for message in read_export(path, FIELDS):
+        rows.append(tuple(message[field] for field in FIELDS))
+        if len(rows) >= batch:
+            c.executemany(query, rows)
+            conn.commit()
+            total += len(rows)
+            rows = []
+            print("Imported", total)
+    c.executemany(query, rows)
+    total += len(rows)
+
+    c.execute("ANALYZE;")
+    conn.commit()
+    return total
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Export a tgstats database to chunked JSONL or Parquet files, or import such an export')
+    parser.add_argument('name', type=str, help="Database name")
+    parser.add_argument('path', type=str, help="Export folder")
+    parser.add_argument('--format', default="jsonl", choices=sorted(EXTENSIONS), help="Format of the part files (default: gzipped JSONL)")
+    parser.add_argument('--chunk', type=int, default=100000, help="Number of messages per part file")
+    parser.add_argument('--no-json', action='store_true', help="Leave out the raw message json. Such exports can't be imported.")
+    parser.add_argument('--import', dest='import_export', action='store_true', help="Create database name.db from the export")
+    args = parser.parse_args()
+
+    if args.import_export:
+        if os.path.exists("%s.db" % args.name):
+            print("Database %s.db already exists" % args.name)
+            sys.exit(1)
+
+        conn = sqlite3.connect("%s.db" % args.name)
+        db.create_tables(conn.cursor())
+        try:
+            print("Imported %d messages to %s.db" % (import_export(args.path, conn), args.name))
+        except (ValueError, RuntimeError) as e:
+            print(e)
+            conn.close()
+            os.remove("%s.db" % args.name)
+            sys.exit(1)
+        conn.close()
+
+    else:
+        if not os.path.exists("%s.db" % args.name):
+            print("No such database %s.db" % args.name)
+            sys.exit(1)
+
+        conn = sqlite3.connect("%s.db" % args.name)
+        c = conn.cursor()
+        if db.missing_columns(c):
+            print("Outdated database schema! Run ./dump.py %s --migrate" % args.name)
+            sys.exit(1)
+
+        fields = [field for field in FIELDS if field != "json"] if args.no_json else FIELDS
+        try:
+            manifest = export(c, args.path, args.format, args.chunk, fields)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+        print("Exported %d messages in %d parts to %s" % (manifest["rows"], len(manifest["parts"]), args.path))
+        conn.close()
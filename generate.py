@@ -1,179 +1,1494 @@
 #!/usr/bin/env python3
 
 import argparse
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import sqlite3, json, datetime
-import time, math, os, re
+import sqlite3, json, datetime, zoneinfo
+import time, math, os, re, sys, collections
+import concurrent.futures, glob, contextlib, heapq, hashlib
+import db, export
 
+# matplotlib, numpy and cProfile are imported only when needed, so text
+# only reports start fast.
 
-def chat_renames():
+
+# Profiler of the current report, see --profile
+profiler = None
+
+
+class Profiler:
+    """
+        Collects wall time, rows, text bytes and peak memory of report sections.
+        Memory is the peak RSS during the section, including its nested
+        sections, above the RSS at its start. The peak is reset per section
+        through /proc/self/clear_refs, elsewhere it is not measured.
+    """
+
+    def __init__(self):
+        self.sections = {}
+        # RSS at the start and peak so far of the open sections
+        self.open = []
+
+    @staticmethod
+    def memory():
+        """
+            Current and peak RSS in kB and reset the peak, None if not supported
+        """
+
+        try:
+            with open("/proc/self/status") as f:
+                status = dict(line.split(":", 1) for line in f)
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return int(status["VmRSS"].split()[0]), int(status["VmHWM"].split()[0])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def entry(self, name):
+        return self.sections.setdefault(name, {"time": 0.0, "rows": 0, "bytes": 0, "peak_mb": None, "state_kb": None})
+
+    @contextlib.contextmanager
+    def section(self, name):
+        entry = self.entry(name)
+        memory = self.memory()
+        if memory and self.open:
+            self.open[-1][1] = max(self.open[-1][1], memory[1])
+        self.open.append([memory[0], memory[0]] if memory else None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry["time"] += time.perf_counter() - start
+            memory, rss = self.memory(), self.open.pop()
+            if memory and rss:
+                peak = max(rss[1], memory[1])
+                if self.open and self.open[-1]:
+                    self.open[-1][1] = max(self.open[-1][1], peak)
+                entry["peak_mb"] = max(entry["peak_mb"] or 0, (peak - rss[0]) / 1024.0)
+
+    def count(self, name, elapsed, rows=1, size=0):
+        entry = self.entry(name)
+        entry["time"] += elapsed
+        entry["rows"] += rows
+        entry["bytes"] += size
+
+    def summary(self):
+        print("\n%-24s %9s %10s %10s %9s %9s" % ("Section", "Time (s)", "Rows", "Text KB", "State KB", "Peak +MB"))
+        for name, entry in self.sections.items():
+            print("%-24s %9.3f %10d %10.1f %9s %9s" % (name, entry["time"], entry["rows"], entry["bytes"] / 1024.0,
+                "-" if entry["state_kb"] is None else "%.1f" % entry["state_kb"],
+                "-" if entry["peak_mb"] is None else "%.1f" % entry["peak_mb"]))
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.sections, f, indent=4)
+
+
+def section(name):
+    """
+        Context manager timing a report section when profiling
+    """
+
+    return profiler.section(name) if profiler else contextlib.nullcontext()
+
+
+# Print query plans of the report queries, see --explain
+explain = False
+slow_plans = []
+
+
+def explain_query(name, query, params=()):
+    """
+        Print EXPLAIN QUERY PLAN of a report query. Full scans of the
+        messages table and sorts for ORDER BY are reported as slow plans.
+    """
+
+    print("Query plan of %s:" % name)
+    for row in c.execute("EXPLAIN QUERY PLAN " + query, params):
+        detail = row[3]
+        slow = (detail.startswith("SCAN messages") and "INDEX" not in detail) or "FOR ORDER BY" in detail
+        print("  %s%s" % (detail, "  <-- SLOW" if slow else ""))
+        if slow:
+            slow_plans.append((name, detail))
+
+
+Tokens = collections.namedtuple("Tokens", "words emojis mentions command")
+
+
+class Tokenizer:
+    """
+        Splits message text in a single regex pass into lowercase words,
+        emoji code points, @mentions and a leading /command. Words are at
+        least two characters of the alphabet, which is given as the contents
+        of a regex character class (e.g. "a-zäöå" or "a-zа-яё").
+    """
+
+    emojis = (u'\U0001F300-\U0001F5FF'
+              u'\U0001F600-\U0001F64F'
+              u'\U0001F680-\U0001F6FF'
+              u'\u2600-\u26FF\u2700-\u27BF')
+
+    def __init__(self, alphabet="a-zäöå"):
+        self.alphabet = alphabet
+        self.pattern = re.compile(u"(^/\\S*)|@(\\w+)|([%s]{2,})|([%s])" % (alphabet, self.emojis))
+
+    def tokenize(self, text):
+        words, emojis, mentions, command = [], [], [], None
+
+        for cmd, mention, word, emoji in self.pattern.findall(text.lower()):
+            if word:
+                words.append(word)
+            elif emoji:
+                emojis.append(ord(emoji))
+            elif mention:
+                mentions.append(mention)
+            else:
+                # Commands keep their case
+                command = text.split(None, 1)[0].split("@")[0]
+
+        return Tokens(words, emojis, mentions, command)
+
+
+# Tokenizer shared by all statistics, see --alphabet
+tokenizer = Tokenizer()
+
+
+# Time zone of the days and hours in the report, see --timezone. None is the local time.
+timezone = None
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def timezone_name():
+    return str(timezone) if timezone else "local"
+
+
+def utc_offset(timestamp):
+    """
+        UTC offset of the report time zone at the timestamp in seconds
+    """
+
+    if timezone is None:
+        return time.localtime(timestamp).tm_gmtoff
+    return int(datetime.datetime.fromtimestamp(timestamp, timezone).utcoffset().total_seconds())
+
+
+def local_date(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, timezone).date()
+
+
+def local_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, timezone)
+
+
+def midnight(date):
+    """
+        Timestamp of the start of the date in the report time zone
+    """
+
+    return datetime.datetime.combine(date, datetime.time(), timezone).timestamp()
+
+
+def local_seconds(timestamps):
+    """
+        Convert an array of timestamps to seconds since 1970-01-01 in the
+        report time zone. The UTC offset is looked up at the start and end
+        of every UTC day with messages; only the few days with a time zone
+        transition are looked up per quarter hour.
+    """
+
+    import numpy as np
+
+    if not len(timestamps):
+        return timestamps
+
+    first = int(timestamps.min()) // 86400
+    days = timestamps // 86400 - first
+    present = np.flatnonzero(np.bincount(days))
+
+    offsets = np.zeros(96 * (int(days.max()) + 1), dtype=np.int64)
+    for day in present:
+        start = (first + int(day)) * 86400
+        offset = utc_offset(start)
+        if offset == utc_offset(start + 86399):
+            offsets[96 * day:96 * (day + 1)] = offset
+        else:
+            offsets[96 * day:96 * (day + 1)] = [utc_offset(start + 900 * i) for i in range(96)]
+
+    return timestamps + offsets[timestamps // 900 - 96 * first]
+
+
+def day_counts(timestamps, weights=None):
+    """
+        Return list of (local date as YYYY-MM-DD, count or sum of weights) of the days with messages
+    """
+
+    import numpy as np
+
+    if not len(timestamps):
+        return []
+
+    days = local_seconds(timestamps) // 86400
+    first = int(days.min())
+    counts = np.bincount(days - first, weights)
+    return [((EPOCH + datetime.timedelta(days=first + int(day))).isoformat(), counts[day].item())
+            for day in np.flatnonzero(np.bincount(days - first))]
+
+
+def column(rows, index=0):
+    import numpy as np
+    return np.fromiter((row[index] for row in rows), dtype=np.int64, count=len(rows))
+
+
+# Columns of the messages table passed to Statistic.add(). The rows also
+# have the integer key and bot flag of the sender as from_key and from_bot.
+SCAN_COLUMNS = ["timestamp", "event", "text", "media_type", "action_type", "action_title"]
+
+
+class Statistic:
+    """
+        Accumulator interface for scan(). Every row of the messages table
+        with an event listed in `events` is passed to add() exactly once,
+        in timestamp order, and result() is called after the scan. If
+        `uses_tokens` is set, the Tokens of the message text are passed too.
+
+        Statistics that are plain aggregates can instead define `query`,
+        a GROUP BY query evaluated by SQLite, whose rows are passed to load().
+        The query must restrict rows with "timestamp >= :start AND
+        +rowid > :since AND +rowid <= :until". The unary plus keeps SQLite
+        from preferring the rowid range over the timestamp indexes. For
+        exports, which have no SQL, select() returns the query's row of
+        a message and rows of `events` are loaded in batches instead.
+
+        Incremental statistics can persist their state with get_state() and
+        continue from it later. Rows up to rowid `since` and older than
+        timestamp `start` are then skipped.
+
+        For parallel scans empty() returns a new statistic with the same
+        options, and merge() folds in a statistic fed with later rows.
+    """
+
+    events = ("message", )
+    query = None
+    uses_tokens = False
+    incremental = True
+    since = 0
+    start = 0
+    label = None
+
+    def key(self):
+        return self.__class__.__name__
+
+    def add(self, timestamp, row, tokens):
+        raise NotImplementedError
+
+    def load(self, rows):
+        raise NotImplementedError
+
+    def select(self, timestamp, row):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def get_state(self):
+        raise NotImplementedError
+
+    def set_state(self, state):
+        raise NotImplementedError
+
+    def store(self, c):
+        """
+            Write state kept outside the aggregates table. Called before the
+            high-water mark is committed.
+        """
+        pass
+
+    def empty(self):
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+
+def scan(stats, until=None, jobs=1, users=True):
+    """
+        Stream the messages table once and feed every row to the given
+        statistics, reading only the normalized columns. Only rows up to
+        rowid `until` are read. With multiple jobs the rows are split into
+        timestamp ranges which are scanned in parallel. Senders are added
+        to the users table first unless `users` is false, see
+        update_users(). Returns list of results.
+    """
+
+    if until is None:
+        until = c.execute("SELECT IFNULL(MAX(rowid), 0) FROM messages;").fetchone()[0]
+
+    # Senders of the new messages get their keys before the scan, also for the worker processes
+    if users:
+        until = update_users(min([stat.since for stat in stats] or [0]), until)
+
+    # Statistics with the same query and range share it. Rows are loaded
+    # in chunks so memory doesn't grow with the number of messages.
+    row_stats, queries = [], {}
+    for stat in stats:
+        if stat.query:
+            queries.setdefault((stat.query, stat.start, stat.since), []).append(stat)
+        else:
+            row_stats.append(stat)
+
+    for (query, start, since), group in queries.items():
+        params = {"start": start, "since": since, "until": until}
+        if explain:
+            explain_query(", ".join(stat.label or stat.key() for stat in group), query, params)
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            # Fetching is counted for the first statistic of the group
+            begin = time.perf_counter()
+            rows = cursor.fetchmany(65536)
+            if not rows:
+                break
+            for stat in group:
+                stat.load(rows)
+                if profiler:
+                    profiler.count("  " + (stat.label or stat.key()), time.perf_counter() - begin, len(rows))
+                    begin = time.perf_counter()
+
+    if jobs > 1 and row_stats:
+        feed_parallel(row_stats, until, jobs)
+    else:
+        feed(row_stats, until)
+
+    return [stat.result() for stat in stats]
+
+
+def scan_export(stats, rows, names=None):
+    """
+        Feed rows of an export, dicts in timestamp order, to the statistics
+        in one pass. Senders get keys in the order they are seen, and their
+        latest names are stored to dict `names`. Returns list of results.
+    """
+
+    users = {}
+    if names is None:
+        names = {}
+
+    def numbered(rows):
+        # Everything in an export is new, rowids only need to be positive
+        for rowid, row in enumerate(rows, 1):
+            row["rowid"] = rowid
+            if row["from_id"] is None:
+                row["from_key"] = None
+            else:
+                row["from_key"] = users.setdefault(row["from_id"], len(users) + 1)
+                names[row["from_key"]] = row["from_name"]
+            row["from_bot"] = db.is_bot(row["from_name"])
+            yield row
+
+    stats = [QueryRows(stat) if stat.query else stat for stat in stats]
+    dispatch(stats, numbered(rows))
+    return [stat.result() for stat in stats]
+
+
+class QueryRows(Statistic):
+    """
+        Feeds a query statistic from single rows: the rows its query would
+        return are collected with select() and passed to load() in batches
+    """
+
+    def __init__(self, stat, batch=65536):
+        self.stat = stat
+        self.batch = batch
+        self.rows = []
+        self.events = stat.events
+        self.label = stat.label
+
+    def key(self):
+        return self.stat.key()
+
+    def add(self, timestamp, row, tokens):
+        selected = self.stat.select(timestamp, row)
+        if selected is not None:
+            self.rows.append(selected)
+            if len(self.rows) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.stat.load(self.rows)
+            self.rows = []
+
+    def result(self):
+        self.flush()
+        return self.stat.result()
+
+
+def update_users(since, until):
+    """
+        Give the senders of the messages after rowid `since` their user
+        keys. If another process keeps the database locked, returns the
+        rowid before the first message of a sender without a key so that
+        only the messages up to it are scanned, otherwise `until`.
+    """
+
+    try:
+        db.update_users(c, since)
+        conn.commit()
+        return until
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        first = since + 1
+        if c.execute("SELECT name FROM sqlite_master WHERE name = 'users';").fetchone():
+            first = c.execute("SELECT MIN(rowid) FROM messages WHERE rowid > ? AND rowid <= ? AND from_id NOT IN (SELECT user_id FROM users);",
+                (since, until)).fetchone()[0]
+        until = until if first is None else first - 1
+        print("Users not updated: %s, scanning messages up to %d" % (e, until))
+        return until
+
+
+def feed(stats, until, first=None, last=None, sampled=False):
+    """
+        Feed rows up to rowid `until` and within timestamp range [first, last)
+        to the statistics. With `sampled` only rows of the sample table are read.
+    """
+
+    events = sorted(set(event for stat in stats for event in stat.events))
+    ranges = set((stat.since, stat.start) for stat in stats)
+
+    if not events:
+        return
+
+    # Every statistic reads a timestamp range, which the indexes serve in
+    # order. A sample table is stored in timestamp order.
+    source = "temp.sample CROSS JOIN messages ON messages.rowid = sample.message" if sampled else "messages"
+    order = " ORDER BY sample.position;" if sampled else " ORDER BY timestamp;"
+    query = "SELECT messages.rowid AS rowid, %s, users.key AS from_key, users.bot AS from_bot " \
+            "FROM %s LEFT JOIN users ON users.user_id = messages.from_id " \
+            "WHERE event IN (%s) AND timestamp >= ? AND +messages.rowid <= ? AND (%s)" % (
+            ", ".join(SCAN_COLUMNS), source, ", ".join("?" * len(events)),
+            " OR ".join(["+messages.rowid > ? AND timestamp >= ?"] * len(ranges)))
+    params = events + [min(start for since, start in ranges), until] + [x for r in sorted(ranges) for x in r]
+
+    if first is not None:
+        query += " AND timestamp >= ?"
+        params.append(first)
+    if last is not None:
+        query += " AND timestamp < ?"
+        params.append(last)
+
+    if explain:
+        explain_query("scan", query + order, params)
+
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    dispatch(stats, cursor.execute(query + order, params))
+
+
+def dispatch(stats, rows):
+    """
+        Pass rows in timestamp order to the statistics listening to their event
+    """
+
+    listeners = {}
+    for stat in stats:
+        for event in stat.events:
+            listeners.setdefault(event, []).append(stat)
+
+    # Each text is tokenized once for all statistics
+    tokenize = tokenizer.tokenize if any(stat.uses_tokens for stat in stats) else None
+    tokens = None
+
+    read = 0
+    for row in rows:
+        read += 1
+        rowid, timestamp, text = row["rowid"], row["timestamp"], row["text"]
+
+        if tokenize:
+            if profiler:
+                start = time.perf_counter()
+            tokens = tokenize(text) if text is not None else None
+            if profiler:
+                profiler.count("  tokenize", time.perf_counter() - start, 1, len(text.encode()) if text else 0)
+
+        for stat in listeners.get(row["event"], ()):
+            if rowid > stat.since and timestamp >= stat.start:
+                if profiler:
+                    start = time.perf_counter()
+                    stat.add(timestamp, row, tokens)
+                    profiler.count("  " + (stat.label or stat.key()), time.perf_counter() - start,
+                        1, len(text.encode()) if text else 0)
+                else:
+                    stat.add(timestamp, row, tokens)
+
+    if profiler:
+        profiler.count("scan", 0, read)
+
+
+def feed_range(path, stats, until, first, last, words, zone):
+    """
+        Worker process entry point for feed_parallel()
+    """
+
+    global conn, c, profiler, tokenizer, explain, timezone
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    profiler = None
+    explain = False
+    tokenizer = words
+    timezone = zone
+
+    feed(stats, until, first, last)
+    return stats
+
+
+def feed_parallel(stats, until, jobs):
+    """
+        Split the messages still to be scanned into timestamp ranges of
+        about equal size, feed each range to empty copies of the statistics
+        in a process pool and merge the partial statistics back in
+        timestamp order.
+    """
+
+    path = c.execute("PRAGMA database_list;").fetchone()[2]
+
+    # Restored statistics only read the rows after their since and start
+    remaining = "timestamp >= ? AND +rowid > ? AND +rowid <= ?"
+    params = (min(stat.start for stat in stats), min(stat.since for stat in stats), until)
+    total = c.execute("SELECT COUNT(*) FROM messages WHERE %s;" % remaining, params).fetchone()[0]
+    if not total:
+        return
+
+    # Range boundaries never split a timestamp so ranges don't overlap
+    bounds = set()
+    for i in range(1, jobs):
+        bound = c.execute("SELECT timestamp FROM messages WHERE %s ORDER BY timestamp LIMIT 1 OFFSET ?;" % remaining,
+            params + (i * total // jobs, )).fetchone()
+        if bound is not None:
+            bounds.add(bound[0])
+    bounds = [None] + sorted(bounds) + [None]
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        parts = [pool.submit(feed_range, path, [stat.empty() for stat in stats], until, first, last, tokenizer, timezone)
+                 for first, last in zip(bounds[:-1], bounds[1:])]
+        for part in parts:
+            for stat, partial in zip(stats, part.result()):
+                stat.merge(partial)
+
+
+def sample_messages(rate, until, method="stratified", seed=0):
+    """
+        Fill temp table "sample" with the rowids of a sample of `rate` of the
+        messages up to rowid `until`, and of all service messages, which are
+        few and not counted. The stratified sample picks one message at random
+        from every 1 / rate messages in timestamp order, the uniform sample
+        every message with probability `rate`. The rows are stored in
+        timestamp order. Returns number of sampled messages.
+    """
+
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    if method != "uniform":
+        total = c.execute("SELECT COUNT(*) FROM messages WHERE event = 'message' AND +rowid <= ?;", (until, )).fetchone()[0]
+        strata = math.ceil(total * rate)
+        bounds = np.floor(np.arange(strata + 1) / rate).astype(np.int64)
+        positions = bounds[:-1] + (rng.random(strata) * (bounds[1:] - bounds[:-1])).astype(np.int64)
+        positions = positions[positions < total]
+
+    # The event index has the rowids in timestamp order. They are read in
+    # chunks and only the sampled ones are kept.
+    query = "SELECT rowid FROM messages WHERE event = ? AND +rowid <= ? ORDER BY timestamp;"
+    cursor = conn.cursor()
+    cursor.execute(query, ("message", until))
+    parts, offset = [], 0
+    while True:
+        rows = cursor.fetchmany(65536)
+        if not rows:
+            break
+        rowids = column(rows)
+        if method == "uniform":
+            chosen = np.flatnonzero(rng.random(len(rowids)) < rate)
+        else:
+            first, last = np.searchsorted(positions, [offset, offset + len(rowids)])
+            chosen = positions[first:last] - offset
+        parts.append(rowids[chosen])
+        offset += len(rowids)
+    sampled = sum(len(part) for part in parts)
+
+    # Sampled messages and the service messages are sorted by timestamp,
+    # keeping the index order of equal timestamps
+    c.execute("DROP TABLE IF EXISTS temp.chosen;")
+    c.execute("CREATE TEMP TABLE chosen (message INTEGER);")
+    for part in parts:
+        c.executemany("INSERT INTO temp.chosen VALUES (?);", ((rowid, ) for rowid in part.tolist()))
+    c.executemany("INSERT INTO temp.chosen VALUES (?);", c.execute(query, ("service", until)).fetchall())
+    c.execute("DROP TABLE IF EXISTS temp.sample;")
+    c.execute("CREATE TEMP TABLE sample (position INTEGER PRIMARY KEY, message INTEGER);")
+    c.execute("INSERT INTO temp.sample (message) SELECT messages.rowid FROM temp.chosen CROSS JOIN messages "
+              "ON messages.rowid = chosen.message ORDER BY messages.timestamp, chosen.rowid;")
+    c.execute("DROP TABLE temp.chosen;")
+    return sampled
+
+
+def scan_sample(stats, until):
+    """
+        Feed the rows of the sample table to fresh statistics in one pass.
+        Query statistics are fed row by row. Returns list of results.
+    """
+
+    # Only the senders of the sample need keys
+    db.create_users(c)
+    db.add_users(c, c.execute("SELECT from_id, from_name, MAX(timestamp) FROM temp.sample "
+        "CROSS JOIN messages ON messages.rowid = sample.message GROUP BY from_id;").fetchall())
+    conn.commit()
+
+    stats = [QueryRows(stat) if stat.query else stat for stat in stats]
+    feed(stats, until, sampled=True)
+    return [stat.result() for stat in stats]
+
+
+def budget_rate(args, until, budget):
+    """
+        Return the sampling rate whose sampling and scan take about `budget`
+        seconds. Reading the rowids is timed on their first chunk and the
+        scan on a pilot sample of it, so the messages are read only once.
+    """
+
+    total, services = c.execute("SELECT SUM(event = 'message'), SUM(event = 'service') FROM messages "
+        "WHERE event IN ('message', 'service') AND +rowid <= ?;", (until, )).fetchone()
+
+    # Reading the rowids costs the same for every rate
+    start = time.perf_counter()
+    rowids = c.execute("SELECT rowid FROM messages WHERE event = 'message' AND +rowid <= ? ORDER BY timestamp LIMIT 65536;",
+        (until, )).fetchall()
+    fixed = (time.perf_counter() - start) * (total or 0) / max(len(rowids), 1)
+
+    # Scanning grows with the sampled messages, service messages are always scanned
+    pilot = rowids[::max(1, len(rowids) // 2000)]
+    c.execute("DROP TABLE IF EXISTS temp.sample;")
+    c.execute("CREATE TEMP TABLE sample (position INTEGER PRIMARY KEY, message INTEGER);")
+    c.executemany("INSERT INTO temp.sample (message) VALUES (?);", pilot)
+    start = time.perf_counter()
+    scan_sample(list(report_statistics(args).values()), until)
+    per_row = (time.perf_counter() - start) / max(len(pilot), 1)
+
+    return max(min(1.0, 2000.0 / max(total or 0, 1)), (budget - fixed - per_row * (services or 0)) / per_row / max(total or 0, 1))
+
+
+class EmojiSquares(Statistic):
+    """
+        Sums of the squared per message counts of every emoji. They give the
+        variance of the emoji counts estimated from a sample.
+    """
+
+    uses_tokens = True
+    incremental = False
+
+    def __init__(self):
+        self.emojis = {}
+
+    def add(self, timestamp, row, tokens):
+        if tokens is None:
+            return
+
+        for emoji, count in collections.Counter(tokens.emojis).items():
+            self.emojis[emoji] = self.emojis.get(emoji, 0) + count * count
+
+    def result(self):
+        return self.emojis
+
+
+def scale_count(count, rate):
+    return int(round(count / rate))
+
+
+def sample_error(squares, rate):
+    """
+        Half width of the 95% confidence interval of a total estimated by
+        scaling sampled per message values by 1 / rate, from the sum of the
+        squared sampled values. For a count of messages that is the sampled
+        count. The variance is that of independently sampled messages,
+        which the stratified sample doesn't exceed.
+    """
+
+    return 1.96 * math.sqrt(max(squares, 0) * (1 - rate)) / rate
+
+
+def scale_results(results, rate, squares=None):
+    """
+        Scale the results of statistics fed with a sample of `rate` of the
+        messages to estimates of all messages. Population and topics come
+        from service messages, which are not sampled. The confidence
+        intervals of the emoji counts are added from EmojiSquares
+        `squares`. Returns results.
+    """
+
+    if "messages" in results:
+        results["messages"] = {date: scale_count(count, rate) for date, count in results["messages"].items()}
+    if "activity" in results:
+        results["activity"] = [scale_count(count, rate) for count in results["activity"]]
+    if "rate" in results:
+        results["rate"] = {window: (scale_count(count, rate), start, end) for window, (count, start, end) in results["rate"].items()}
+    if "bots" in results:
+        cmds, bots = results["bots"]
+        results["bots"] = ([(cmd, [(user, scale_count(count, rate)) for user, count in users]) for cmd, users in cmds],
+                           [(user, scale_count(count, rate)) for user, count in bots])
+    if "emojis" in results:
+        sums = squares.emojis if squares else {}
+        results["emojis_errors"] = {emoji: sample_error(sums.get(emoji, count), rate) for emoji, count in results["emojis"]}
+        results["emojis"] = [(emoji, scale_count(count, rate)) for emoji, count in results["emojis"]]
+    if "words" in results:
+        results["words"] = [(word, scale_count(count, rate)) for word, count in results["words"]]
+
+    results["sample"] = rate
+    return results
+
+
+def restore(accumulators, rebuild=False):
+    """
+        Restore persisted state of the incremental statistics so that only
+        rows added after the previous run need to be scanned
+    """
+
+    db.create_aggregates(c)
+    if rebuild:
+        return
+
+    first = {}
+    for name, stat in accumulators.items():
+        saved = db.load_aggregate(c, name)
+        if not stat.incremental or saved is None or saved[0] != stat.key():
+            continue
+
+        key, last_rowid, last_timestamp, state = saved
+
+        # Messages dumped older than the high-water mark would break the
+        # time ordered statistics so those have to be recomputed
+        if last_rowid not in first:
+            first[last_rowid] = c.execute("SELECT MIN(timestamp) FROM messages WHERE rowid > ?;", (last_rowid, )).fetchone()[0]
+        if first[last_rowid] is not None and first[last_rowid] < last_timestamp:
+            print("Older messages added, recomputing", name)
+            continue
+
+        # Rows after the high-water mark are never older than it
+        stat.set_state(json.loads(state))
+        stat.since = last_rowid
+        stat.start = last_timestamp
+
+
+def persist(accumulators, until):
+    """
+        Store state of the incremental statistics with the high-water mark.
+        Statistics which another process has stored since they were
+        restored are skipped, as the rollups are added to and would count
+        the same rows twice. Returns names of the skipped statistics, or
+        None if the database stayed locked and nothing was stored.
+    """
+
+    last_timestamp = c.execute("SELECT MAX(timestamp) FROM messages WHERE rowid <= ?;", (until, )).fetchone()[0]
+
+    # The check and the writes are one transaction so reports running at
+    # the same time (generate.py, daemon.py) can't interleave
+    conn.commit()
+    try:
+        c.execute("BEGIN IMMEDIATE;")
+        stored, skipped = [], []
+        for name, stat in accumulators.items():
+            if not stat.incremental:
+                continue
+            saved = db.load_aggregate(c, name)
+            if stat.since and (saved is None or saved[0] != stat.key() or saved[1] != stat.since):
+                skipped.append(name)
+                continue
+            stat.store(c)
+            stored.append(name)
+        db.save_aggregates(conn, [
+            (name, accumulators[name].key(), until, last_timestamp or 0, json.dumps(accumulators[name].get_state()))
+            for name in stored
+        ])
+    except sqlite3.OperationalError as e:
+        # E.g. dump.py holding the write lock, the next run stores the rows
+        conn.rollback()
+        print("Statistics not stored: %s" % e)
+        return None
+
+    # Later rows continue from the stored state
+    for name in stored:
+        accumulators[name].since = until
+    if skipped:
+        print("Statistics %s were stored by another process meanwhile, not storing them" % ", ".join(skipped))
+    return skipped
+
+
+class ChatRenames(Statistic):
+    """
+        List of topics
+    """
+
+    query = """SELECT timestamp, action_title, (SELECT key FROM users WHERE user_id = from_id) FROM messages
+               WHERE event="service" AND action_type="chat_rename"
+                     AND timestamp >= :start AND +rowid > :since AND +rowid <= :until;"""
+    events = ("service", )
+
+    def __init__(self):
+        self.renames = []
+
+    def key(self):
+        return "ChatRenames(users)"
+
+    def load(self, rows):
+        self.renames.extend(rows)
+
+    def select(self, timestamp, row):
+        if row["action_type"] == "chat_rename":
+            return timestamp, row["action_title"], row["from_key"]
+
+    def result(self):
+        return sorted([(
+                local_time(timestamp),
+                title,
+                user
+            ) for timestamp, title, user in self.renames], key=lambda x: x[0], reverse=True)
+
+    def get_state(self):
+        return self.renames
+
+    def set_state(self, state):
+        self.renames = [tuple(rename) for rename in state]
+
+
+class UserDaily(Statistic):
+    """
+        Daily per talker counters [messages, words, stickers, photos] keyed
+        by the user key. The counters are stored in the user_daily table and
+        new messages are added to it, so talker statistics over any range of
+        days are sums of a few rollup rows.
+    """
+
+    uses_tokens = True
+
+    def __init__(self):
+        self.days = {}
+        # Local day of the previous row and its bounds as timestamps
+        self.day = None
+        self.day_start = self.day_end = 0
+
+    def key(self):
+        return "UserDaily(users,%s,%s)" % (tokenizer.alphabet, timezone_name())
+
+    def add(self, timestamp, row, tokens):
+        # Rows come in timestamp order so the day changes rarely
+        if not self.day_start <= timestamp < self.day_end:
+            date = local_date(timestamp)
+            self.day = date.isoformat()
+            self.day_start = midnight(date)
+            self.day_end = midnight(date + datetime.timedelta(days=1))
+
+        key = (self.day, row["from_key"])
+        if key not in self.days:
+            self.days[key] = [0, 0, 0, 0]
+        counts = self.days[key]
+
+        if row["text"] is not None:
+            counts[0] += 1
+            counts[1] += len(tokens.words)
+
+        elif row["media_type"] is not None:
+            media_type = row["media_type"]
+
+            if media_type == "photo":
+                counts[3] += 1
+            elif media_type == "document":
+                counts[2] += 1
+
+    def totals(self, first=None, last=None):
+        """
+            Sum the counters of days first..last (YYYY-MM-DD, inclusive) per talker
+        """
+
+        talkers = {}
+        for (day, user), counts in self.days.items():
+            if (first is None or day >= first) and (last is None or day <= last):
+                if user not in talkers:
+                    talkers[user] = [0, 0, 0, 0]
+                talkers[user] = [a + b for a, b in zip(talkers[user], counts)]
+        return talkers.items()
+
+    def result(self):
+        return self.days
+
+    def get_state(self):
+        # State lives in the user_daily table, see store()
+        return None
+
+    def set_state(self, state):
+        pass
+
+    def store(self, c):
+        db.create_rollups(c)
+        if self.since == 0:
+            c.execute("DELETE FROM user_daily;")
+        db.add_rollups(c, [key + tuple(counts) for key, counts in self.days.items()])
+
+    def empty(self):
+        stat = UserDaily()
+        stat.since = self.since
+        return stat
+
+    def merge(self, other):
+        for key, counts in other.days.items():
+            if key not in self.days:
+                self.days[key] = [0, 0, 0, 0]
+            self.days[key] = [a + b for a, b in zip(self.days[key], counts)]
+
+
+class BotSpammers(Statistic):
+    """
+        Most used bot commands and their users, and most active bots, by user key
+    """
+
+    uses_tokens = True
+
+    def __init__(self):
+        self.cmds = {}
+        self.bots = {}
+
+    def key(self):
+        return "BotSpammers(users)"
+
+    def add(self, timestamp, row, tokens):
+        user = row["from_key"]
+
+        if tokens is not None and tokens.command is not None:
+
+            cmd = tokens.command
+
+            if cmd in self.cmds:
+                if user in self.cmds[cmd]:
+                    self.cmds[cmd][user] += 1
+                else:
+                    self.cmds[cmd][user] = 1
+            else:
+                self.cmds[cmd] = { user: 1 }
+
+        elif row["from_bot"]:
+            # Increase bot's popularity
+            if user in self.bots:
+                self.bots[user] += 1
+            else:
+                self.bots[user] = 1
+
+    def result(self):
+        # Filter Top-6 commands
+        cmds = sorted(self.cmds.items(), key=lambda x: sum(x[1].values()), reverse=True)[:6]
+
+        # Filter Top-6 users for each command
+        cmds = [(c[0], sorted(c[1].items(), key=lambda x: x[1], reverse=True)[:6]) for c in cmds]
+
+        # Filter Top-5 Bots
+        bots = sorted(self.bots.items(), key=lambda x: x[1], reverse=True)[:5]
+
+        return cmds, bots
+
+    def get_state(self):
+        # Pairs, as json would turn the integer keys to strings
+        return [[[cmd, list(users.items())] for cmd, users in self.cmds.items()], list(self.bots.items())]
+
+    def set_state(self, state):
+        cmds, bots = state
+        self.cmds = {cmd: dict(users) for cmd, users in cmds}
+        self.bots = dict(bots)
+
+    def empty(self):
+        stat = BotSpammers()
+        stat.since = self.since
+        return stat
+
+    def merge(self, other):
+        for cmd, users in other.cmds.items():
+            cmd_users = self.cmds.setdefault(cmd, {})
+            for user, count in users.items():
+                cmd_users[user] = cmd_users.get(user, 0) + count
+        for user, count in other.bots.items():
+            self.bots[user] = self.bots.get(user, 0) + count
+
+
+class SpaceSaving:
+    """
+        Streaming top-k counter (Space-Saving by Metwally et al.) keeping at
+        most `capacity` counters. Each estimated count overestimates the
+        true count by at most its error, and every error is at most
+        total / capacity. Every item occurring more than total / capacity
+        times is guaranteed to have a counter.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self.counters = {}
+
+        # Min-heap of (count, item) with one entry per counter. Entries can
+        # be stale (too small) and are fixed lazily when they reach the top.
+        self.heap = []
+
+    def add(self, item):
+        self.total += 1
+
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += 1
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [1, 0]
+            heapq.heappush(self.heap, (1, item))
+        else:
+            # Take over the counter with the smallest count
+            low, victim = self.pop_minimum()
+            del self.counters[victim]
+            self.counters[item] = [low + 1, low]
+            heapq.heappush(self.heap, (low + 1, item))
+
+    def pop_minimum(self):
+        while True:
+            low, item = heapq.heappop(self.heap)
+            if self.counters[item][0] == low:
+                return low, item
+            heapq.heappush(self.heap, (self.counters[item][0], item))
+
+    def minimum(self):
+        """
+            Upper bound of the count of any item without a counter
+        """
+
+        if len(self.counters) < self.capacity:
+            return 0
+        low, item = self.pop_minimum()
+        heapq.heappush(self.heap, (low, item))
+        return low
+
+    def top(self, n):
+        return [(item, count) for item, (count, error) in
+                heapq.nlargest(n, self.counters.items(), key=lambda x: x[1][0])]
+
+    def merge(self, other):
+        low, other_low = self.minimum(), other.minimum()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            a = self.counters.get(item, (low, low))
+            b = other.counters.get(item, (other_low, other_low))
+            merged[item] = [a[0] + b[0], a[1] + b[1]]
+
+        self.counters = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda x: x[1][0]))
+        self.heap = [(count, item) for item, (count, error) in self.counters.items()]
+        heapq.heapify(self.heap)
+        self.total += other.total
+
+    def get_state(self):
+        return [self.capacity, self.total, [[item, count, error] for item, (count, error) in self.counters.items()]]
+
+    def set_state(self, state):
+        self.capacity, self.total, counters = state
+        self.counters = {item: [count, error] for item, count, error in counters}
+        self.heap = [(count, item) for item, (count, error) in self.counters.items()]
+        heapq.heapify(self.heap)
+
+
+class CommonWords(Statistic):
+    """
+        Most commonly used words. With `capacity` the words are counted
+        approximately with a SpaceSaving summary of that many counters.
+    """
+
+    uses_tokens = True
+
+    def __init__(self, top=100, capacity=None):
+        self.top = top
+        self.capacity = capacity
+        self.words = {} if capacity is None else SpaceSaving(capacity)
+
+    def key(self):
+        return "CommonWords(%s,%s)" % (self.capacity or "exact", tokenizer.alphabet)
+
+    def add(self, timestamp, row, tokens):
+        if tokens is None:
+            return
+
+        words = self.words
+        if self.capacity is None:
+            for mword in tokens.words:
+                if mword not in words:
+                    words[mword] = 1
+                else:
+                    words[mword] += 1
+        else:
+            for mword in tokens.words:
+                words.add(mword)
+
+    def result(self):
+        if self.capacity is None:
+            return heapq.nlargest(self.top, self.words.items(), key=lambda x: x[1])
+        return self.words.top(self.top)
+
+    def error_bound(self):
+        """
+            Maximum overestimate of the approximate counts
+        """
+
+        return 0 if self.capacity is None else self.words.minimum()
+
+    def get_state(self):
+        return self.words if self.capacity is None else self.words.get_state()
+
+    def set_state(self, state):
+        if self.capacity is None:
+            self.words = state
+        else:
+            self.words.set_state(state)
+
+    def empty(self):
+        stat = CommonWords(self.top, self.capacity)
+        stat.since = self.since
+        return stat
+
+    def merge(self, other):
+        if self.capacity is None:
+            for mword, count in other.words.items():
+                self.words[mword] = self.words.get(mword, 0) + count
+        else:
+            self.words.merge(other.words)
+
+
+class PeakRates(Statistic):
+    """
+        Most messages inside each of the sliding time windows (in seconds).
+        Each window keeps a deque of the text message timestamps inside it
+        so every message is appended and expired exactly once.
+    """
+
+    def __init__(self, windows=(60, 600, 3600, 86400)):
+        self.windows = tuple(windows)
+        self.buffs = [collections.deque() for _ in self.windows]
+        self.tops = [(0, 0, 0) for _ in self.windows]
+
+        # Timestamps within the first window of the scanned range, needed
+        # to find the peaks crossing range boundaries when merging
+        self.first = None
+        self.heads = [[] for _ in self.windows]
+
+    def key(self):
+        return "PeakRates(%s)" % ",".join(map(str, self.windows))
+
+    def add(self, timestamp, row, tokens):
+        if row["text"] is None:
+            return
+
+        if self.first is None:
+            self.first = timestamp
+
+        for i, window in enumerate(self.windows):
+            if timestamp < self.first + window:
+                self.heads[i].append(timestamp)
+            self.push(i, timestamp)
+
+    def push(self, i, timestamp):
+        buff = self.buffs[i]
+        buff.append(timestamp)
+
+        # Expire messages which fell out of the window
+        while buff[0] + self.windows[i] <= timestamp:
+            buff.popleft()
+
+        if len(buff) > self.tops[i][0]:
+            self.tops[i] = (len(buff), buff[0], timestamp)
+
+    def result(self):
+        return {window: (rate, local_time(start), local_time(end))
+                for window, (rate, start, end) in zip(self.windows, self.tops)}
+
+    def get_state(self):
+        return [list(buff) for buff in self.buffs], self.tops
+
+    def set_state(self, state):
+        buffs, tops = state
+        self.buffs = [collections.deque(buff) for buff in buffs]
+        self.tops = [tuple(top) for top in tops]
+
+    def empty(self):
+        stat = PeakRates(self.windows)
+        stat.since = self.since
+        return stat
+
+    def merge(self, other):
+        if other.first is None:
+            return
+
+        for i, window in enumerate(self.windows):
+            # Every window crossing the boundary ends inside other's head
+            for timestamp in other.heads[i]:
+                self.push(i, timestamp)
+
+            # Prefer the earlier peak on ties like a serial scan does
+            top = other.tops[i]
+            if top[0] > self.tops[i][0] or (top[0] == self.tops[i][0] and top[2] < self.tops[i][2]):
+                self.tops[i] = top
+
+            # Unless other's head covered all of its messages its buffer is the newer one
+            if other.buffs[i][-1] >= other.first + window:
+                self.buffs[i] = other.buffs[i]
+
+
+class PopularEmojis(Statistic):
     """
-        Returns list of topics
+        Most popular emoji code points. With `capacity` the emojis are
+        counted approximately with a SpaceSaving summary.
     """
 
-    print("Getting topics...")
+    uses_tokens = True
 
-    renames = []
-    for sid, timestamp, service  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="service" ORDER BY timestamp;"""):
-        service = json.loads(service)
-        if service["action"]["type"] == "chat_rename":
-            renames.append((
-                datetime.datetime.fromtimestamp(timestamp),
-                service["action"]["title"],
-                service["from"]["print_name"].replace("_", " ")
-            ))
+    def __init__(self, top=20, capacity=None):
+        self.top = top
+        self.capacity = capacity
+        self.emojis = {} if capacity is None else SpaceSaving(capacity)
 
-    return sorted(renames, key=lambda x: x[0], reverse=True)
+    def key(self):
+        return "PopularEmojis(%s)" % (self.capacity or "exact")
 
+    def add(self, timestamp, row, tokens):
+        if tokens is None:
+            return
 
-def talker_stats(span=None, max_talkers=10):
-    """"
-        Return list of top talkers in decending order
+        if self.capacity is None:
+            for ec in tokens.emojis:
+                self.emojis[ec] = self.emojis.get(ec, 0) + 1
+        else:
+            for ec in tokens.emojis:
+                self.emojis.add(ec)
+
+    def result(self):
+        if self.capacity is None:
+            return heapq.nlargest(self.top, self.emojis.items(), key=lambda x: x[1])
+        return self.emojis.top(self.top)
+
+    def error_bound(self):
+        """
+            Maximum overestimate of the approximate counts
+        """
+
+        return 0 if self.capacity is None else self.emojis.minimum()
+
+    def get_state(self):
+        return self.emojis if self.capacity is None else self.emojis.get_state()
+
+    def set_state(self, state):
+        if self.capacity is None:
+            self.emojis = {int(ec): count for ec, count in state.items()}
+        else:
+            self.emojis.set_state(state)
+
+    def empty(self):
+        stat = PopularEmojis(self.top, self.capacity)
+        stat.since = self.since
+        return stat
+
+    def merge(self, other):
+        if self.capacity is None:
+            for ec, count in other.emojis.items():
+                self.emojis[ec] = self.emojis.get(ec, 0) + count
+        else:
+            self.emojis.merge(other.emojis)
+
+
+class MessagesPerDay(Statistic):
+    """
+        Number of messages for each day
     """
 
-    print("Getting top talkers...")
-    i = 0
-    talkers = {}
+    query = """SELECT timestamp FROM messages
+               WHERE event="message" AND timestamp >= :start AND +rowid > :since AND +rowid <= :until;"""
 
-    before = int(time.time() - span*24*60*60) if span else 0
+    def __init__(self):
+        self.messages = {}
 
-    for sid, timestamp, message  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="message" AND timestamp >= ?;""", (before, )):
-        message = json.loads(message)
-        name = message["from"]["print_name"]
+    def key(self):
+        return "MessagesPerDay(%s)" % timezone_name()
 
-        if name not in talkers:
-            talkers[name] = [0, 0, 0, 0]
+    def load(self, rows):
+        self.count(column(rows))
 
-        if "text" in message:
-            talkers[name][0] += 1
-            talkers[name][1] += len(re.findall('[a-zäöå]{2,}', message["text"], flags=re.IGNORECASE))
+    def select(self, timestamp, row):
+        return (timestamp, )
 
-        elif "media" in message:
-            media_type = message["media"]["type"]
+    def count(self, timestamps):
+        for date, count in day_counts(timestamps):
+            self.messages[date] = self.messages.get(date, 0) + count
 
-            if media_type == "photo":
-                talkers[name][3] += 1
-            elif media_type == "document":
-                talkers[name][2] += 1
-            elif media_type == "geo":
-                pass
-            elif media_type == "contact":
-                pass
+    def result(self):
+        return {datetime.datetime.strptime(date, "%Y-%m-%d").date(): count for date, count in self.messages.items()}
 
-    return talkers.items()
+    def get_state(self):
+        return self.messages
 
+    def set_state(self, state):
+        self.messages = state
 
-def bot_spammers(max_talkers=10):
 
-    print("Getting top bot spammers...")
-    cmds = {}
-    bots = {}
+class HourlyActivity(Statistic):
+    """
+        Number of messages for each hour of the day
+    """
 
-    for sid, timestamp, message  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="message";"""):
-        message = json.loads(message)
-        name = message["from"]["print_name"]
+    query = """SELECT timestamp FROM messages
+               WHERE event="message" AND timestamp >= :start AND +rowid > :since AND +rowid <= :until;"""
 
-        if "text" in message and message["text"].startswith("/"):
+    def __init__(self):
+        self.messages = 24 * [0]
 
-            cmd = message["text"].strip().split(" ")[0].split("@")[0]
+    def key(self):
+        return "HourlyActivity(%s)" % timezone_name()
 
-            #print(cmd, "\t", message["text"])
+    def load(self, rows):
+        self.count(column(rows))
 
-            if cmd in cmds:
-                if name in cmds[cmd]:
-                    cmds[cmd][name] += 1
-                else:
-                    cmds[cmd][name] = 1
-            else:
-                cmds[cmd] = { name: 1 }
+    def select(self, timestamp, row):
+        return (timestamp, )
 
-        elif name.lower()[-3:]== "bot":
-            # Increase bot's popularity
-            if name in bots:
-                bots[name] += 1
-            else:
-                bots[name] = 1
+    def count(self, timestamps):
+        import numpy as np
+        hours = np.bincount(local_seconds(timestamps) % 86400 // 3600, minlength=24)
+        self.messages = [a + int(b) for a, b in zip(self.messages, hours)]
 
+    def result(self):
+        return self.messages
 
-    # Filter Top-6 commands
-    cmds = sorted(cmds.items(), key=lambda x: sum(x[1].values()), reverse=True)[:6]
+    def get_state(self):
+        return self.messages
 
-    # Filter Top-6 users for each command
-    cmds = [(c[0], sorted(c[1].items(), key=lambda x: x[1], reverse=True)[:6]) for c in cmds]
+    def set_state(self, state):
+        self.messages = state
 
-    # Filter Top-5 Bots
-    bots = sorted(bots.items(), key=lambda x: x[1], reverse=True)[:5]
 
-    return cmds, bots
+class Population(Statistic):
+    """
+        Daily [members, joined, left] counters
+    """
 
+    query = """SELECT timestamp, action_type != "chat_del_user" FROM messages
+               WHERE event="service" AND action_type IN ("chat_add_user", "chat_add_user_link", "chat_del_user")
+                     AND timestamp >= :start AND +rowid > :since AND +rowid <= :until;"""
+    events = ("service", )
 
-def most_commonly_used_words():
+    def __init__(self):
+        self.changes = {}
+
+    def key(self):
+        return "Population(%s)" % timezone_name()
+
+    def load(self, rows):
+        timestamps, joins = column(rows, 0), column(rows, 1)
+        for (date, total), (_, joined) in zip(day_counts(timestamps), day_counts(timestamps, joins)):
+            day = self.changes.setdefault(date, [0, 0])
+            day[0] += int(joined)
+            day[1] -= int(total - joined)
+
+    def select(self, timestamp, row):
+        if row["action_type"] in ("chat_add_user", "chat_add_user_link", "chat_del_user"):
+            return timestamp, row["action_type"] != "chat_del_user"
+
+    def result(self):
+        import numpy as np
+        dates = sorted(self.changes)
+        changes = np.array([self.changes[date] for date in dates], dtype=np.int64).reshape(-1, 2)
+        totals = np.cumsum(changes.sum(axis=1))
+        return {datetime.date.fromisoformat(date): [int(total), int(joined), int(left)]
+                for date, total, (joined, left) in zip(dates, totals, changes)}
+
+    def get_state(self):
+        return self.changes
+
+    def set_state(self, state):
+        self.changes = state
+
+
+def chat_renames():
+    """
+        Returns list of topics
+    """
+
+    print("Getting topics...")
+    return resolve_names({"topics": scan([ChatRenames()])[0]}, db.user_names(c))["topics"]
+
+
+def talker_stats(span=None, max_talkers=10):
     """"
-        Return list of most commonly used words
+        Return list of top talkers in decending order
     """
 
-    print("Getting most commonly used words...")
+    print("Getting top talkers...")
+    stat = UserDaily()
+    scan([stat])
+    first, last = day_range(span)
+    return resolve_names({"talkers": stat.totals(first, last)}, db.user_names(c))["talkers"]
 
-    words = {}
-    users = {}
-    for sid, timestamp, message  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="message";"""):
-        message = json.loads(message)
 
-        if "text" not in message:
-            continue
+def day_range(span=None, until=None):
+    """
+        Return (first, last) day of the span of days ending at day `until`
+        or at the day of the last message
+    """
 
-        for mword in re.findall('[a-zäöå]{2,}', message["text"], flags=re.IGNORECASE):
-            mword = mword.lower()
-            if mword not in words:
-                words[mword] = 1
-            else:
-                words[mword] += 1
+    if until is None:
+        last_timestamp = c.execute("SELECT MAX(timestamp) FROM messages;").fetchone()[0]
+        if last_timestamp is None:
+            return None, None
+        until = local_date(last_timestamp).isoformat()
+    if span is None:
+        return None, until
 
-            if mword[0] == "@":
-                if mword not in users:
-                    users[mword] = 1
-                else:
-                    users[mword] += 1
+    first = datetime.date.fromisoformat(until) - datetime.timedelta(days=span - 1)
+    return first.isoformat(), until
 
-    #print(sorted(users.items(), key=lambda x: x[1], reverse=True)[:10])
-    return sorted(words.items(), key=lambda x: x[1], reverse=True)
 
+def bot_spammers(max_talkers=10):
+
+    print("Getting top bot spammers...")
+    return resolve_names({"bots": scan([BotSpammers()])[0]}, db.user_names(c))["bots"]
 
-def population_graph(filepath="aski_population.png", show=False):
 
-    print("Creating population graph...")
+def most_commonly_used_words():
+    """"
+        Return list of most commonly used words
+    """
+
+    print("Getting most commonly used words...")
+    return scan([CommonWords()])[0]
+
+
+def hourly_rate(timespan=3600):
+    """
+        Calculate most messages inside the timespan
+    """
+
+    print("Calculating message rates...")
+    return scan([PeakRates([timespan])])[0][timespan]
 
-    population = {}
-    total = 0
 
-    prev_date = None
+def popular_emojis():
 
-    for sid, timestamp, service  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="service" ORDER BY timestamp;"""):
-        service = json.loads(service)
+    print("Searching emojis...")
+    return scan([PopularEmojis()])[0]
 
-        action_type = service["action"]["type"]
 
-        if action_type not in ["chat_add_user", "chat_add_user_link", "chat_del_user"]:
-            continue
+def pyplot():
+    """
+        Import pyplot on first use with the non-interactive Agg backend
+    """
 
-        timestamp = datetime.datetime.fromtimestamp(timestamp)
-        date = datetime.date(timestamp.year, timestamp.month, timestamp.day)
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 
-        #  Init table for the date
-        if date != prev_date:
-            population[date] = [total, 0, 0]
-        prev_date = date
 
-        if action_type == "chat_add_user" or action_type == "chat_add_user_link":
-            total += 1
-            population[date][0] = total
-            population[date][1] += 1
+def population_graph(population, filepath="aski_population.png", dpi=250):
 
-        elif action_type == "chat_del_user":
-            total -= 1
-            population[date][0] = total
-            population[date][2] -= 1
+    print("Creating population graph...")
 
     # TODO: Add today to the list if doesn't exist
     #if population[-1] != today:
@@ -189,6 +1504,8 @@ def population_graph(filepath="aski_population.png", show=False):
         income.append(vals[1])
         outcome.append(vals[2])
 
+    plt = pyplot()
+    import matplotlib.dates as mdates
     fig, ax = plt.subplots()
     fig.set_size_inches(14, 6)
 
@@ -196,7 +1513,7 @@ def population_graph(filepath="aski_population.png", show=False):
     ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%y'))
 
     ax.set_xlim(datetime.date(dates[0].year, dates[0].month, 1), datetime.date(dates[-1].year, dates[-1].month, dates[-1].day))
-    ax.set_ylim(10 * math.floor(min(outcome) / 10.), 20 * math.ceil((1 + total) / 20.))
+    ax.set_ylim(10 * math.floor(min(outcome) / 10.), 20 * math.ceil((1 + members[-1]) / 20.))
 
     ax.plot(dates, members)
 
@@ -207,68 +1524,22 @@ def population_graph(filepath="aski_population.png", show=False):
     plt.ylabel('Members')
     plt.title('Population')
     plt.grid(True)
-    plt.savefig(filepath, dpi=250)
-    if show:
-        plt.show()
-
-
-def hourly_rate(timespan=3600):
-    """
-        Calculate most messages inside the timespan
-    """
-
-    print("Calculating message rates...")
-
-    buff = []
-    top_date, top_rate = (0, 0), 0
-
-    for sid, timestamp, message  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="message" ORDER BY timestamp;"""):
-        message = json.loads(message)
-
-        # Append new message to the buffer
-        if "text" in message:
-            buff.append(timestamp)
-
-        # Filter old messages
-        buff = [x for x in buff if x + timespan > timestamp]
-
-        if len(buff) > top_rate:
-            top_rate = len(buff)
-            top_date = (buff[0], buff[-1])
-            #print(top_date, top_rate, message["text"])
-
-    return top_rate, datetime.datetime.fromtimestamp(top_date[0]), \
-           datetime.datetime.fromtimestamp(top_date[1])
+    plt.savefig(filepath, dpi=dpi)
+    plt.close(fig)
 
 
-def messages_graph(filepath="messages.png", show=True):
+def messages_graph(messages, filepath="messages.png", dpi=250):
 
     print("Creating messages graphs...")
 
-    messages = {}
-    prev_date = None
-
-
-    for sid, timestamp, message  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="message" ORDER BY timestamp;"""):
-        message = json.loads(message)
-
-        timestamp = datetime.datetime.fromtimestamp(timestamp)
-        date = datetime.date(timestamp.year, timestamp.month, timestamp.day)
-
-        #  Init table for the date
-        if date != prev_date:
-            messages[date] = 0
-        prev_date = date
-
-        messages[date] += 1
-
-
     dates = []
     mgs = []
     for date, vals in sorted(messages.items(), key=lambda x: x[0]):
         dates.append(date)
         mgs.append(vals)
 
+    plt = pyplot()
+    import matplotlib.dates as mdates
     fig, ax = plt.subplots()
     fig.set_size_inches(14, 6)
 
@@ -284,51 +1555,15 @@ def messages_graph(filepath="messages.png", show=True):
     plt.ylabel('Messages')
     plt.title('Messages per day')
     plt.grid(True)
-    plt.savefig(filepath, dpi=250)
-    if show:
-        plt.show()
-
-
-
-def popular_emojis():
-
-    print("Searching emojis...")
-
-    highpoints = re.compile(u'['
-        u'\U0001F300-\U0001F5FF'
-        u'\U0001F600-\U0001F64F'
-        u'\U0001F680-\U0001F6FF'
-        u'\u2600-\u26FF\u2700-\u27BF]',
-        re.UNICODE)
-
-    emojis = {}
-
-    for mid, message in c.execute("""SELECT id, json FROM messages WHERE event="message";"""):
-        message = json.loads(message)
-
-        if "text" not in message:
-            continue
-
-        #if len(r) > 0:
-        #print(r, hex(ord(r[0])))
-        for ec in map(ord, highpoints.findall(message["text"])):
-            emojis[ec] = emojis.get(ec, 0) + 1
-
-    return sorted(emojis.items(), key=lambda x: x[1], reverse=True)[:20]
+    plt.savefig(filepath, dpi=dpi)
+    plt.close(fig)
 
 
-
-def activity_graph(filepath="activity.png", show=True):
+def activity_graph(messages, filepath="activity.png", dpi=250):
 
     print("Creating activity graph...")
 
-    messages = 24 * [0]
-    for sid, timestamp, message  in c.execute("""SELECT id, timestamp, json FROM messages WHERE event="message" ORDER BY id;"""):
-        message = json.loads(message)
-
-        timestamp = datetime.datetime.fromtimestamp(timestamp)
-        messages[timestamp.hour] += 1
-
+    plt = pyplot()
     fig, ax = plt.subplots()
     fig.set_size_inches(14, 4)
 
@@ -340,174 +1575,763 @@ def activity_graph(filepath="activity.png", show=True):
     plt.ylabel('Messages')
     plt.title('Activity')
     plt.grid(True)
-    plt.savefig(filepath, dpi=250)
+    plt.savefig(filepath, dpi=dpi)
+    plt.close(fig)
 
-    if show:
-        plt.show()
 
+def render_graphs(graphs, jobs=1):
+    """
+        Render list of (graph function, data, filepath, dpi) in worker processes
+    """
 
+    if jobs > 1 and len(graphs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(graphs))) as pool:
+            for future in [pool.submit(*graph) for graph in graphs]:
+                future.result()
+    else:
+        for graph in graphs:
+            with section("  " + graph[0].__name__):
+                graph[0](*graph[1:])
 
-if __name__ == "__main__":
 
-    parser = argparse.ArgumentParser(description='')
-    parser.add_argument('name', type=str, help="Will be used as database name")
-    parser.add_argument('--no-population', action='store_true', help="Disable population graph")
-    parser.add_argument('--no-messages', action='store_true', help="Disable messages graph")
-    parser.add_argument('--no-activity', action='store_true', help="Disable activity graph")
-    parser.add_argument('--no-general', action='store_true', help="Disable general stats")
-    parser.add_argument('--no-talkers', action='store_true', help="Disable top talkers")
-    parser.add_argument('--no-topics', action='store_true', help="Disable topic list")
-    parser.add_argument('--no-words', action='store_true', help="Disable most commonly used words list")
-    parser.add_argument('--no-bots', action='store_true', help="Disable most commonly used bots/commands list")
-    parser.add_argument('--no-emojis', action='store_true', help="Disable most commonly used emojis list")
-    args = parser.parse_args()
+timeranges = [
+    ("all", "All-time", None),
+    ("week", "Last week", 7),
+    ("month", "Last month", 31),
+    ("year", "Last year", 365)
+]
 
-    if len(args.name) < 3:
-        print("Invalid name!")
+rate_windows = [
+    (60, "minute"),
+    (600, "10 minutes"),
+    (3600, "hour"),
+    (86400, "day")
+]
 
-    conn = sqlite3.connect("%s.db" % args.name)
-    c = conn.cursor()
+
+def generate_report(name, args, jobs=1):
+    """
+        Generate statistics report of database "name.db" to folder "name".
+        With args.from_export the messages are read from that export folder
+        instead and nothing is stored between runs.
+        Returns (number of rows, elapsed time) or None on failure.
+    """
+
+    global conn, c, profiler, tokenizer, explain, timezone
+    source = args.from_export
+    if source:
+        conn = c = None
+        try:
+            manifest = export.load_manifest(source)
+        except ValueError as e:
+            print(e)
+            return None
+        if not manifest["rows"]:
+            print("No messages in export %s" % source)
+            return None
+    else:
+        conn = sqlite3.connect("%s.db" % name, timeout=db.BUSY_TIMEOUT)
+        c = conn.cursor()
+
+        if db.missing_columns(c):
+            print("Outdated database schema! Run ./dump.py %s --migrate" % name)
+            return None
+        if db.missing_indexes(c):
+            print("Missing indexes %s, queries will be slow! Run ./dump.py %s --migrate" % (", ".join(db.missing_indexes(c)), name))
+
+    start = time.time()
+    profiler = Profiler() if args.profile or args.profile_json or args.profile_pstats else None
+    if args.profile_pstats:
+        import cProfile
+        pstats_profile = cProfile.Profile()
+        pstats_profile.enable()
+    tokenizer = Tokenizer(args.alphabet)
+    timezone = args.timezone
+    explain = args.explain
+    del slow_plans[:]
 
 
     # Try to create a folder
     try:
-        os.mkdir(args.name)
+        os.mkdir(name)
     except OSError:
         pass
 
+
+    # Collect every enabled statistic so the database is scanned only once
+    accumulators = report_statistics(args)
+
+    if source:
+        until = manifest["rows"]
+        last_day = local_date(manifest["last"]).isoformat()
+
+        print("Reading export %s..." % source)
+        with section("scan"):
+            names = {}
+            fields = SCAN_COLUMNS + ["from_id", "from_name"]
+            results = dict(zip(accumulators.keys(), scan_export(list(accumulators.values()), export.read_export(source, fields), names)))
+
+        def export_totals(first, last):
+            return list(accumulators["daily"].totals(first, last))
+
+        totals = export_totals
+
+    else:
+        until = c.execute("SELECT IFNULL(MAX(rowid), 0) FROM messages;").fetchone()[0]
+        last_day = None
+        if not until:
+            print("No messages in %s.db" % name)
+            return None
+
+        rate = args.sample
+        if args.budget:
+            with section("budget"):
+                rate = budget_rate(args, until, args.budget)
+
+    if not source and rate < 1:
+        # Preview from a sample, nothing is stored
+        print("Sampling %.2f%% of messages..." % (100.0 * rate))
+        with section("sample"):
+            sampled = sample_messages(rate, until, args.sample_method)
+        if not sampled:
+            print("No messages in the sample, use a higher --sample rate")
+            return None
+        with section("scan"):
+            squares = EmojiSquares()
+            results = dict(zip(accumulators.keys(), scan_sample(list(accumulators.values()) + [squares], until)))
+            scale_results(results, rate, squares)
+        print("Estimated from %d messages" % sampled)
+
+        def sampled_totals(first, last):
+            return [(user, [scale_count(count, rate) for count in counts]) for user, counts in accumulators["daily"].totals(first, last)]
+
+        totals = sampled_totals
+        names = db.user_names(c)
+
+    elif not source:
+        # Continue from the previous run and fold in only the new messages
+        with section("restore"):
+            restore(accumulators, args.rebuild)
+
+        print("Scanning messages...")
+        with section("scan"):
+            # The high-water mark is where the scan stops if the users can't be updated
+            until = update_users(min(stat.since for stat in accumulators.values()), until)
+            results = dict(zip(accumulators.keys(), scan(list(accumulators.values()), until, jobs, users=False)))
+
+        with section("persist"):
+            stored = persist(accumulators, until) is not None
+
+        totals = rollup_totals
+        if not stored and "daily" in accumulators:
+            totals = pending_totals(accumulators["daily"], accumulators["daily"].since > 0)
+        names = db.user_names(c)
+        if explain and "daily" in accumulators:
+            explain_query("talkers", db.USER_TOTALS, ("", "9999-12-31"))
+
+    cache = FragmentCache("%s/.cache" % name, args.cache_size * 1024) if args.cache_size else None
+    write_report(name, args, accumulators, results, totals, names, last_day, cache, jobs)
+
+    if conn:
+        conn.close()
+
+    if explain:
+        print("%d slow query plans%s" % (len(slow_plans), "".join("\n  %s: %s" % plan for plan in slow_plans)))
+        explain = False
+
+    if profiler:
+        for label, stat in accumulators.items():
+            if stat.incremental and "  " + label in profiler.sections:
+                profiler.sections["  " + label]["state_kb"] = len(json.dumps(stat.get_state())) / 1024.0
+        print("Report %s" % name)
+        profiler.summary()
+        if args.profile_json:
+            profiler.write_json("%s/profile.json" % name)
+        if args.profile_pstats:
+            pstats_profile.disable()
+            pstats_profile.dump_stats("%s/profile.pstats" % name)
+        profiler = None
+
+    return until, time.time() - start
+
+
+def report_statistics(args):
+    """
+        Return the statistics enabled by args keyed by their result name
+    """
+
+    accumulators = {}
+    if not args.no_population:
+        accumulators["population"] = Population()
+    if not args.no_messages:
+        accumulators["messages"] = MessagesPerDay()
+    if not args.no_activity:
+        accumulators["activity"] = HourlyActivity()
+    if not args.no_general or not args.no_talkers:
+        accumulators["daily"] = UserDaily()
+    if not args.no_general:
+        accumulators["rate"] = PeakRates([window for window, unit in rate_windows])
+    if not args.no_bots:
+        accumulators["bots"] = BotSpammers()
+    if not args.no_emojis:
+        accumulators["emojis"] = PopularEmojis(capacity=args.approx_emojis or None)
+    if not args.no_words:
+        accumulators["words"] = CommonWords(capacity=args.approx_words or None)
+    if not args.no_topics:
+        accumulators["topics"] = ChatRenames()
+
+    for label, stat in accumulators.items():
+        stat.label = label
+    return accumulators
+
+
+def rollup_totals(first=None, last=None):
+    """
+        Return list of (user key, counters) summed from the daily rollups
+    """
+
+    return [(user, list(counts)) for user, *counts in db.user_totals(c, first, last)]
+
+
+def pending_totals(daily, rollups=True):
+    """
+        Return totals(first, last) of the counters of UserDaily `daily`,
+        which aren't stored, plus the daily rollups of the earlier messages
+        if `rollups`
+    """
+
+    def totals(first=None, last=None):
+        talkers = dict(rollup_totals(first, last)) if rollups else {}
+        for user, counts in daily.totals(first, last):
+            talkers[user] = [a + b for a, b in zip(talkers.get(user, [0, 0, 0, 0]), counts)]
+        return list(talkers.items())
+
+    return totals
+
+
+def display_name(name):
+    return name.replace("_", " ") if name is not None else "Unknown"
+
+
+def resolve_names(results, names):
+    """
+        Replace the user keys in the talker, bot and topic results with
+        display names from dict of user key to print name. Returns results.
+    """
+
+    display = {user: display_name(name) for user, name in names.items()}
+
+    def name(user):
+        return display.get(user, "Unknown")
+
+    for label in list(results):
+        if label.startswith("talkers"):
+            results[label] = sorted([(name(user), counts) for user, counts in results[label]], key=lambda talker: talker[0])
+    if "bots" in results:
+        cmds, bots = results["bots"]
+        results["bots"] = ([(cmd, [(name(user), count) for user, count in users]) for cmd, users in cmds],
+                           [(name(user), count) for user, count in bots])
+    if "topics" in results:
+        results["topics"] = [(changed, title, name(user)) for changed, title, user in results["topics"]]
+    return results
+
+
+def write_report(name, args, accumulators, results, totals, names, last_day=None, cache=None, jobs=1):
+    """
+        Add talker tables and error bounds to the results of the statistics
+        and write the graphs and the page of report "name". totals(first, last)
+        returns the talker counters of a range of days and `names` maps the
+        user keys to print names.
+    """
+
+    title = os.path.basename(name)
+
+    # Talker tables are summed from the daily rollups
+    if "daily" in accumulators:
+        with section("talkers"):
+            ranges = [("all", None, None)]
+            if not args.no_talkers:
+                ranges += [(trange, ) + day_range(span, args.until or last_day) for trange, label, span in timeranges[1:]]
+                if args.since or args.until:
+                    ranges.append(("custom", args.since, args.until))
+            for trange, first, last in ranges:
+                results["talkers" if trange == "all" else "talkers_" + trange] = totals(first, last)
+
+    # Users are keyed by integers until the output
+    resolve_names(results, names)
+
+    for label in ["words", "emojis"]:
+        if label in accumulators:
+            results[label + "_error"] = accumulators[label].error_bound()
+            if results.get("sample"):
+                results[label + "_error"] = scale_count(results[label + "_error"], results["sample"])
+
+    graphs = []
     if not args.no_population:
-        population_graph("%s/population.png" % args.name, show=False)
+        graphs.append((population_graph, results["population"], "%s/population.%s" % (name, args.format), args.dpi))
     if not args.no_messages:
-        messages_graph("%s/messages.png" % args.name, show=False)
+        graphs.append((messages_graph, results["messages"], "%s/messages.%s" % (name, args.format), args.dpi))
     if not args.no_activity:
-        activity_graph("%s/activity.png" % args.name, show=False)
+        graphs.append((activity_graph, results["activity"], "%s/activity.%s" % (name, args.format), args.dpi))
+
+    # Graphs whose data didn't change since the previous run are kept
+    if cache:
+        inputs = {graph[2]: [graph[0].__name__, sorted(graph[1].items()) if isinstance(graph[1], dict) else graph[1], graph[3]]
+                  for graph in graphs}
+        graphs = [graph for graph in graphs if cache.graph_changed(graph[2], inputs[graph[2]])]
 
+    with section("graphs"):
+        render_graphs(graphs, jobs)
 
-    out = open("%s/index.html" % args.name, "w")
+    with section("html"):
+        if cache:
+            cache.hits = cache.misses = 0
+            for graph in graphs:
+                cache.graph_rendered(graph[2], inputs[graph[2]])
+        write_html(name, title, args, results, cache)
+        if cache:
+            cache.save()
+            print("Reused %d of %d sections" % (cache.hits, cache.hits + cache.misses))
 
-    out.write("""<!DOCTYPE html><html lang="en"><head>
+
+PAGE_HEADER = """<!DOCTYPE html><html lang="en"><head>
     <meta charset="utf-8">
     <meta name="viewport" content="width=device-width, initial-scale=1">
-    <title>%s Telegram Statistics</title>
+    <title>%(title)s Telegram Statistics</title>
     <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" crossorigin="anonymous">
     <script src="https://code.jquery.com/jquery-2.2.4.min.js" crossorigin="anonymous"></script>
     <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/js/bootstrap.min.js" crossorigin="anonymous"></script>
 
     </head><body>
     <div class="container">
-    """ % args.name)
+    <h1>%(title)s Telegram Statistics</h1>"""
 
-    out.write("<h1>%s Telegram Statistics</h1>" % args.name)
+PAGE_FOOTER = """<p>Generated %(date)s with <a href='https://github.com/petrinm/tgstats'>tgstats</a></p>
 
-    if not args.no_general or not args.no_talkers:
-        talkers = talker_stats()
+</div>
+</body></html>"""
 
-    if not args.no_population:
-        out.write("<h2>Members</h2>\n")
-        out.write("<img src='population.png' class='img-responsive' alt='Population over time'/>\n")
+GRAPH_HTML = "<h2>%(header)s</h2>\n<img src='%(file)s' class='img-responsive' alt='%(alt)s'/>\n"
 
-    if not args.no_messages:
-        out.write("<h2>Messages per day</h2>\n")
-        out.write("<img src='messages.png' class='img-responsive' alt='Messages per day'/>\n")
 
-    if not args.no_activity:
-        out.write("<h2>Activity</h2>\n")
-        out.write("<img src='activity.png' class='img-responsive' alt=''/>\n")
+def graph_html(header, filename, alt=""):
+    return GRAPH_HTML % {"header": header, "file": filename, "alt": alt}
 
-    if not args.no_general:
-        out.write("<h2>General numbers</h2>\n<table class='table tabler-striped'>\n")
-
-        top_rate, top_start, top_end = hourly_rate()
-        messages = 0
-        stickers = 0
-        photos = 0
-        for talker, stats in talkers:
-            messages += stats[0]
-            stickers += stats[2]
-            photos += stats[3]
-
-        out.write("<tr><td>Messages</td><td>%d</td></tr>\n" % messages)
-        out.write("<tr><td>Top speed</td><td>%d messages/hour (%s-%s)</td></tr>\n" % (top_rate, top_start.strftime("%d. %B %Y %I:%M"), top_end.strftime("%I:%M")))
-        out.write("<tr><td>Stickers</td><td>%d (%.1f%% of messages)</td></tr>\n" % (stickers, (100.0 * stickers) / messages))
-        out.write("<tr><td>Media</td><td>%d (%.1f%% of messages)</td></tr>\n" % (photos, (100.0 * photos) / messages))
-        #out.write("<tr><td>Videos</td><td>TODO</td></tr>\n")
-        #out.write("<tr><td>Audio</td><td>TODO</td></tr>\n")
-        out.write("</table>\n")
 
+def estimate_html(count, rate=None, error=None, interval=True):
+    """
+        Format a count. Counts estimated from a sample of `rate` of the
+        messages get their 95% confidence interval, by default that of a
+        count of messages, unless `interval` is false.
+    """
 
-    if not args.no_talkers:
+    if not rate:
+        return "%d" % count
+    if not interval:
+        return "~%d" % count
+    if error is None:
+        error = sample_error(count * rate, rate)
+    return "~%d &plusmn;%d" % (count, error)
+
+
+def sample_html(rate):
+    return "<p><b>Preview:</b> counts are estimated from a %.2f%% sample of the messages and shown with their 95%% " \
+           "confidence intervals, word counts without one. Members and topics are exact.</p>\n" % (100.0 * rate)
+
+
+def general_html(talkers, rates, rate=None):
+    out = ["<h2>General numbers</h2>\n<table class='table tabler-striped'>\n"]
+
+    messages = 0
+    stickers = 0
+    photos = 0
+    for talker, stats in talkers:
+        messages += stats[0]
+        stickers += stats[2]
+        photos += stats[3]
+
+    out.append("<tr><td>Messages</td><td>%s</td></tr>\n" % estimate_html(messages, rate))
+    for window, unit in rate_windows:
+        top_rate, top_start, top_end = rates[window]
+        if rate and top_rate * rate < 10:
+            # The busiest window of a few sampled messages overestimates the peak
+            out.append("<tr><td>Top speed</td><td>? messages/%s (too few sampled messages)</td></tr>\n" % unit)
+            continue
+        end_format = "%I:%M" if window < 86400 else "%d. %B %Y %I:%M"
+        out.append("<tr><td>Top speed</td><td>%s messages/%s (%s-%s)</td></tr>\n" % (estimate_html(top_rate, rate), unit, top_start.strftime("%d. %B %Y %I:%M"), top_end.strftime(end_format)))
+    out.append("<tr><td>Stickers</td><td>%s (%.1f%% of messages)</td></tr>\n" % (estimate_html(stickers, rate), (100.0 * stickers) / max(messages, 1)))
+    out.append("<tr><td>Media</td><td>%s (%.1f%% of messages)</td></tr>\n" % (estimate_html(photos, rate), (100.0 * photos) / max(messages, 1)))
+    #out.append("<tr><td>Videos</td><td>TODO</td></tr>\n")
+    #out.append("<tr><td>Audio</td><td>TODO</td></tr>\n")
+    out.append("</table>\n")
+    return "".join(out)
 
-        out.write("<h2>Top 15 Talkers</h2>\n")
 
-        out.write("<ul class=\"nav nav-tabs\">" \
-                  "<li class=\"active\"><a data-toggle=\"tab\" href=\"#all\">All-time</a></li>"\
-                  "<li><a data-toggle=\"tab\" href=\"#week\">Last week</a></li>" \
-                  "<li><a data-toggle=\"tab\" href=\"#month\">Last month</a></li>"\
-                  "<li><a data-toggle=\"tab\" href=\"#year\">Last year</a></li></ul>" \
-                  "<div class=\"tab-content\">\n")
+def talkers_html(tabs, rate=None):
+    """
+        Top talker tables of list of (id, label, talkers) tabs, counters
+        estimated from a sample of `rate` if given
+    """
 
-        timeranges = [
-            ("all", "active", 3600),
-            ("week", "", 7),
-            ("month", "", 31),
-            ("year", "", 365)
-        ]
+    out = ["<h2>Top 15 Talkers</h2>\n"]
 
+    out.append("<ul class=\"nav nav-tabs\">")
+    for trange, label, talks in tabs:
+        out.append("<li%s><a data-toggle=\"tab\" href=\"#%s\">%s</a></li>" % (" class=\"active\"" if trange == "all" else "", trange, label))
+    out.append("</ul><div class=\"tab-content\">\n")
 
-        for trange, active, span in timeranges:
+    for trange, label, talks in tabs:
+        active = "active" if trange == "all" else ""
+        top_talkers = sorted(talks, key=lambda x: x[1][0], reverse=True)[:15]
 
-            talks = talkers if trange == "all" else talker_stats(span)
-            top_talkers = sorted(talks, key=lambda x: x[1][0], reverse=True)[:15]
+        out.append("<div id=\"%s\" class=\"tab-pane %s\"><table class='table tabler-striped'>\n" % (trange, active))
+        out.append("\t<tr><th>#</th><th>Talker</th><th>Messages</th><th>Words</th><th>WPM</th><th>Stickers</th><th>Media</th></tr>\n")
+        pos = 1
+        for talker, counts in top_talkers:
+            messages, words, stickers, photos = counts[:4]
+            out.append("\t<tr><td>%d</td><td>%s</td><td>%s</td><td>%s</td><td>%.1f</td><td>%s</td><td>%s</td></tr>\n" % \
+                (pos, talker, estimate_html(messages, rate), estimate_html(words, rate, interval=False), words / messages if messages else 0,
+                 estimate_html(stickers, rate), estimate_html(photos, rate)))
+            pos += 1
+        out.append("</table></div>\n")
+    out.append("</div>\n")
+    return "".join(out)
 
-            out.write("<div id=\"%s\" class=\"tab-pane %s\"><table class='table tabler-striped'>\n" % (trange, active))
-            out.write("\t<tr><th>#</th><th>Talker</th><th>Messages</th><th>Words</th><th>WPM</th><th>Stickers</th><th>Media</th></tr>\n")
-            pos = 1
-            for talker, (messages, words, stickers, photos) in top_talkers:
-                out.write("\t<tr><td>%d</td><td>%s</td><td>%d</td><td>%d</td><td>%.1f</td><td>%d</td><td>%d</td></tr>\n" % \
-                    (pos, talker.replace("_", " "), messages, words, words / messages, stickers, photos))
-                pos += 1
-            out.write("</table></div>\n")
 
-    if not args.no_bots:
+def bots_html(bot_spammers, rate=None):
+    cmds, bots = bot_spammers
 
-        cmds, bots = bot_spammers()
+    out = ["<h2>Bot spammers</h2>\n<b>Most used bots:</b> "]
+    for bot, count in bots:
+        out.append("%s (%s), " % (bot, estimate_html(count, rate)))
 
-        out.write("<h2>Bot spammers</h2>\n<b>Most used bots:</b> ")
-        for bot, count in bots:
-            out.write("%s (%d), " % (bot, count))
+    out.append("\n<table class='table'><tr>\n")
 
-        out.write("\n<table class='table'><tr>\n")
+    for cmd, users in cmds:
+        out.append("<td><b>%s</b><br/>" % cmd)
+        for user, count in users:
+            out.append("%s (%s), <br/>" % (user, estimate_html(count, rate)))
+        out.append("</td>\n")
 
-        for cmd, users in cmds:
-            out.write("<td><b>%s</b><br/>" % cmd)
-            for user, count in users:
-                out.write("%s (%d), <br/>" % (user.replace("_", " "), count))
-            out.write("</td>\n")
+    out.append("</tr></table>\n")
+    return "".join(out)
 
-        out.write("</tr></table>\n")
 
+def emojis_html(emojis, error, rate=None, errors=None):
+    out = ["<h2>Most popular emojis</h2>\n"]
+    if error:
+        out.append("<p>Approximate counts, overestimated by at most %d uses.</p>\n" % error)
 
-    if not args.no_emojis:
-        out.write("<h2>Most popular emojis</h2>\n")
+    for emoji, count in emojis:
+        out.append("<img width=\"32px\" src=\"http://emojione.com/wp-content/uploads/assets/emojis/%x.svg\" title=\"%s uses\"/>" % (emoji, estimate_html(count, rate, errors and errors.get(emoji))))
+    return "".join(out)
 
-        for emoji, count in popular_emojis():
-            out.write("<img width=\"32px\" src=\"http://emojione.com/wp-content/uploads/assets/emojis/%x.svg\" title=\"%d uses\"/>" % (emoji, count))
 
+def words_html(words, error, rate=None):
+    out = ["<h2>100 most commonly used words</h2>\n<p>\n"]
+    if error:
+        out.append("Approximate counts, overestimated by at most %d uses.<br/>\n" % error)
+    out.append(", ".join([ "%s (%s)" % (word, estimate_html(count, rate, interval=False)) for word, count in words]))
+    out.append("</p>\n")
+    return "".join(out)
 
-    if not args.no_words:
 
-        out.write("<h2>100 most commonly used words</h2>\n<p>\n")
-        out.write(", ".join([ "%s (%d)" % c for c in most_commonly_used_words()[:100]]))
-        out.write("</p>\n")
+def topics_html(topics):
+    out = ["<h2>Latest topics</h2>\n<table class='table tabler-striped'>\n"]
+    for timestamp, title, changer in topics:
+        out.append("\t<tr><td>%s</td><td>Changed by %s (%s)</td></tr>\n" % (title, changer, timestamp.strftime("%d. %B %Y %I:%M")))
+        # TODO: Add deltatime
+    out.append("</table>\n")
+    return "".join(out)
+
 
+def report_sections(args, results):
+    """
+        Return list of (section name, HTML function, arguments) of the enabled report sections
+    """
 
+    sections = []
+    rate = results.get("sample")
+    estimated = " (estimated)" if rate else ""
+    if rate:
+        sections.append(("sample", sample_html, (rate, )))
+    if not args.no_population:
+        sections.append(("population", graph_html, ("Members", "population." + args.format, "Population over time")))
+    if not args.no_messages:
+        sections.append(("messages", graph_html, ("Messages per day" + estimated, "messages." + args.format, "Messages per day")))
+    if not args.no_activity:
+        sections.append(("activity", graph_html, ("Activity" + estimated, "activity." + args.format, "")))
+    if not args.no_general:
+        sections.append(("general", general_html, (results["talkers"], results["rate"], rate)))
+    if not args.no_talkers:
+        tabs = [(trange, label, results["talkers" if trange == "all" else "talkers_" + trange]) for trange, label, span in timeranges]
+        if args.since or args.until:
+            tabs.append(("custom", "%s - %s" % (args.since or "", args.until or ""), results["talkers_custom"]))
+        sections.append(("talkers", talkers_html, (tabs, rate)))
+    if not args.no_bots:
+        sections.append(("bots", bots_html, (results["bots"], rate)))
+    if not args.no_emojis:
+        sections.append(("emojis", emojis_html, (results["emojis"], results["emojis_error"], rate, results.get("emojis_errors"))))
+    if not args.no_words:
+        sections.append(("words", words_html, (results["words"][:100], results["words_error"], rate)))
     if not args.no_topics:
-        out.write("<h2>Latest topics</h2>\n<table class='table tabler-striped'>\n")
-        for timestamp, title, changer in chat_renames()[:10]:
-            out.write("\t<tr><td>%s</td><td>Changed by %s (%s)</td></tr>\n" % (title, changer, timestamp.strftime("%d. %B %Y %I:%M")))
-            # TODO: Add deltatime
-        out.write("</table>\n")
+        sections.append(("topics", topics_html, (results["topics"][:10], )))
+    return sections
+
+
+class FragmentCache:
+    """
+        Rendered report fragments and graph files keyed by a hash of their
+        inputs. Fragments are files in the cache folder; the least recently
+        used ones are evicted when the folder grows over `limit` bytes.
+    """
+
+    # Change when the HTML of the sections changes
+    version = 1
+
+    def __init__(self, path, limit=4 * 1024 * 1024):
+        self.path = path
+        self.limit = limit
+        self.hits = self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+        try:
+            with open(os.path.join(path, "graphs.json")) as f:
+                self.graphs = json.load(f)
+        except (OSError, ValueError):
+            self.graphs = {}
+
+    def key(self, name, inputs):
+        data = json.dumps([self.version, name, inputs], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def fragment(self, name, function, inputs):
+        """
+            Return cached HTML of a section or render and store it
+        """
+
+        path = os.path.join(self.path, "%s-%s.html" % (name, self.key(name, inputs)[:32]))
+        try:
+            with open(path) as f:
+                html = f.read()
+            os.utime(path)
+            self.hits += 1
+            return html
+        except OSError:
+            pass
+
+        self.misses += 1
+        html = function(*inputs)
+        with open(path + ".tmp", "w") as f:
+            f.write(html)
+        os.replace(path + ".tmp", path)
+        return html
+
+    def graph_changed(self, filepath, inputs):
+        """
+            Check if a graph file is missing or was rendered from different inputs
+        """
+
+        return not os.path.exists(filepath) or self.graphs.get(filepath) != self.key(filepath, inputs)
+
+    def graph_rendered(self, filepath, inputs):
+        self.graphs[filepath] = self.key(filepath, inputs)
+
+    def save(self):
+        with open(os.path.join(self.path, "graphs.json"), "w") as f:
+            json.dump(self.graphs, f)
+        self.evict()
+
+    def evict(self):
+        fragments = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".html"):
+                stat = entry.stat()
+                fragments.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, path in fragments)
+        for mtime, size, path in sorted(fragments):
+            if total <= self.limit:
+                break
+            os.remove(path)
+            total -= size
+
+
+def write_html(name, title, args, results, cache=None):
+    """
+        Write the report page "name/index.html" section by section. With a
+        FragmentCache unchanged sections are copied from the cache.
+    """
+
+    with open("%s/index.html.tmp" % name, "w") as out:
+        out.write(PAGE_HEADER % {"title": title})
+
+        for section_name, function, inputs in report_sections(args, results):
+            with section("  html:" + section_name):
+                out.write(cache.fragment(section_name, function, inputs) if cache else function(*inputs))
+
+        out.write(PAGE_FOOTER % {"date": datetime.datetime.now().strftime("%d. %B %Y %H:%M")})
+
+    os.replace("%s/index.html.tmp" % name, "%s/index.html" % name)
+
+
+def find_databases(patterns):
+    """
+        Expand database names, .db files and glob patterns to database names
+    """
+
+    names = []
+    for pattern in patterns:
+        if pattern.endswith(".db"):
+            pattern = pattern[:-3]
+        paths = glob.glob(pattern + ".db") if glob.has_magic(pattern) else [pattern + ".db"]
+        for path in sorted(paths):
+            if path[:-3] not in names:
+                names.append(path[:-3])
+    return names
+
+
+def generate_reports(names, args, index="index.html"):
+    """
+        Generate reports of several databases in a worker pool and
+        write a combined index page with per-chat timings. Returns
+        list of the chats whose report failed.
+    """
 
+    start = time.time()
+    timings = {}
+
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        futures = {pool.submit(generate_report, name, args): name for name in names}
+        for future in concurrent.futures.as_completed(futures):
+            # One broken chat doesn't stop the others
+            try:
+                timings[futures[future]] = future.result()
+            except Exception as e:
+                print("Report %s failed: %s: %s" % (futures[future], e.__class__.__name__, e))
+                timings[futures[future]] = None
+    failed = [name for name in names if not timings.get(name)]
+
+    total = time.time() - start
+    done = sorted([(name, timing) for name, timing in timings.items() if timing], key=lambda x: x[1][1], reverse=True)
+
+    print("\n%-30s %10s %10s %6s" % ("Chat", "Rows", "Time (s)", "Share"))
+    for name, (rows, elapsed) in done:
+        print("%-30s %10d %10.2f %5.1f%%" % (name, rows, elapsed, 100.0 * elapsed / (sum(t[1] for n, t in done) or 1)))
+    print("Total %.2f s with %d workers" % (total, args.jobs))
+    if failed:
+        print("Failed: %s" % ", ".join(failed))
+
+    with open(index, "w") as out:
+        out.write("""<!DOCTYPE html><html lang="en"><head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <title>Telegram Statistics</title>
+    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" crossorigin="anonymous">
+    </head><body>
+    <div class="container">
+    <h1>Telegram Statistics</h1>
+    <table class='table tabler-striped'>
+    \t<tr><th>Chat</th><th>Rows</th><th>Generation time</th></tr>
+""")
+        for name in names:
+            if not timings.get(name):
+                out.write("\t<tr><td>%s</td><td colspan='2'>Failed</td></tr>\n" % os.path.basename(name))
+                continue
+            rows, elapsed = timings[name]
+            out.write("\t<tr><td><a href='%s/index.html'>%s</a></td><td>%d</td><td>%.1f s</td></tr>\n" % (
+                os.path.relpath(name, os.path.dirname(index) or "."), os.path.basename(name), rows, elapsed))
+        out.write("</table>\n<p>Generated %s with <a href='https://github.com/petrinm/tgstats'>tgstats</a></p>\n" %
+            datetime.datetime.now().strftime("%d. %B %Y %H:%M"))
+        out.write("\n</div>\n</body></html>")
+
+    return failed
+
+
+def time_zone(value):
+    try:
+        return zoneinfo.ZoneInfo(value)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise argparse.ArgumentTypeError("unknown time zone %r" % value)
+
+
+def iso_date(value):
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date %r, expected YYYY-MM-DD" % value)
+
+
+def sample_fraction(value):
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = 0
+    if not 0 < rate <= 1:
+        raise argparse.ArgumentTypeError("invalid sampling rate %r, expected 0 < RATE <= 1" % value)
+    return rate
+
+
+def add_report_arguments(parser):
+    """
+        Add the options of report contents and output to an ArgumentParser
+    """
+
+    parser.add_argument('--no-population', action='store_true', help="Disable population graph")
+    parser.add_argument('--no-messages', action='store_true', help="Disable messages graph")
+    parser.add_argument('--no-activity', action='store_true', help="Disable activity graph")
+    parser.add_argument('--no-general', action='store_true', help="Disable general stats")
+    parser.add_argument('--no-talkers', action='store_true', help="Disable top talkers")
+    parser.add_argument('--no-topics', action='store_true', help="Disable topic list")
+    parser.add_argument('--no-words', action='store_true', help="Disable most commonly used words list")
+    parser.add_argument('--no-bots', action='store_true', help="Disable most commonly used bots/commands list")
+    parser.add_argument('--no-emojis', action='store_true', help="Disable most commonly used emojis list")
+    parser.add_argument('--alphabet', default="a-zäöå", help="Letters of words as a regex character class (default: a-zäöå)")
+    parser.add_argument('--approx-words', type=int, default=0, metavar='K', help="Count words approximately with K counters")
+    parser.add_argument('--approx-emojis', type=int, default=0, metavar='K', help="Count emojis approximately with K counters")
+    parser.add_argument('--timezone', type=time_zone, metavar='ZONE', help="Time zone of days and hours, e.g. Europe/Helsinki (default: local time)")
+    parser.add_argument('--since', type=iso_date, metavar='YYYY-MM-DD', help="First day of an extra top talkers tab")
+    parser.add_argument('--until', type=iso_date, metavar='YYYY-MM-DD', help="Last day of the extra top talkers tab and end of the last week/month/year tabs")
+    parser.add_argument('--rebuild', action='store_true', help="Ignore stored statistics and scan all messages again")
+    parser.add_argument('--dpi', type=int, default=250, help="Resolution of the graphs")
+    parser.add_argument('--format', default="png", choices=["png", "svg", "webp"], help="Image format of the graphs")
+    parser.add_argument('--cache-size', type=int, default=4096, metavar='KB', help="Size limit of the cached report sections, 0 disables the cache")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('names', type=str, nargs='+', metavar='name', help="Database names, .db files or glob patterns like 'chats/*.db'")
+    add_report_arguments(parser)
+    parser.add_argument('--from-export', metavar='PATH', help="Read messages from an export of export.py instead of name.db. The report is written to folder name.")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of processes used for scanning messages and rendering graphs")
+    preview = parser.add_mutually_exclusive_group()
+    preview.add_argument('--sample', type=sample_fraction, default=1.0, metavar='RATE', help="Estimate the report quickly from a sample of RATE (0-1) of the messages. Nothing is stored.")
+    preview.add_argument('--budget', type=float, metavar='SECONDS', help="Sample as many messages as can be scanned in about SECONDS")
+    parser.add_argument('--sample-method', default="stratified", choices=["stratified", "uniform"], help="Sample evenly over time or messages independently (default: stratified)")
+    parser.add_argument('--index', default="index.html", help="Combined index page written when generating several reports")
+    parser.add_argument('--explain', action='store_true', help="Print query plans of the report queries and warn about full scans")
+    parser.add_argument('--profile', action='store_true', help="Print time, rows and memory used by each report section")
+    parser.add_argument('--profile-json', action='store_true', help="Write the section profile to name/profile.json")
+    parser.add_argument('--profile-pstats', action='store_true', help="Write a cProfile dump to name/profile.pstats")
+    args = parser.parse_args()
 
-    out.write("<p>Generated %s with <a href='https://github.com/petrinm/tgstats'>tgstats</a></p>\n" % datetime.datetime.now().strftime("%d. %B %Y %H:%M"))
-    out.write("\n</div>\n</body></html>")
+    names = find_databases(args.names)
+
+    if not names:
+        print("No databases match %s" % " ".join(args.names))
+        sys.exit(1)
+    if args.from_export and len(names) != 1:
+        print("Only one report can be generated from an export")
+        sys.exit(1)
+    if args.from_export and (args.sample < 1 or args.budget):
+        print("Exports can't be sampled")
+        sys.exit(1)
+
+    if len(names) == 1:
+        if len(names[0]) < 3:
+            print("Invalid name!")
+        if generate_report(names[0], args, args.jobs) is None:
+            sys.exit(1)
+    elif generate_reports(names, args, args.index):
+        sys.exit(1)
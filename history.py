@@ -0,0 +1,73 @@
+"""
+    Paging helpers shared by dump.py and asyncdump.py
+"""
+
+import os
+
+
+class Backoff:
+    """
+        Exponential retry delay, reset after a successful request
+    """
+
+    def __init__(self, initial=0.5, maximum=60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0
+
+    def success(self):
+        self.delay = 0
+
+    def failure(self):
+        self.delay = min(self.maximum, max(self.initial, 2 * self.delay))
+        return self.delay
+
+
+class PageSize:
+    """
+        History page size tuned from the observed request latency: pages
+        grow while requests finish well within `target` seconds and shrink
+        when they are slow or fail.
+    """
+
+    def __init__(self, size=100, minimum=20, maximum=1000, target=2.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.size = min(max(size, self.minimum), self.maximum)
+        self.target = target
+
+    def success(self, elapsed):
+        if elapsed < self.target / 2:
+            self.size = min(self.maximum, self.size + max(self.size // 2, 1))
+        elif elapsed > self.target:
+            self.size = max(self.minimum, self.size // 2)
+        return self.size
+
+    def failure(self):
+        self.size = max(self.minimum, self.size // 2)
+        return self.size
+
+
+def read_offset(name):
+    """
+        Return the stored history offset of database "name" or 0
+    """
+
+    try:
+        with open("%s_offset" % name, "r") as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_offset(name, offset):
+    """
+        Store history offset atomically so an interrupted dump never leaves a truncated file
+    """
+
+    path = "%s_offset" % name
+    with open(path + ".tmp", "w") as f:
+        f.write("%d" % offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
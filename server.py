@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+import argparse, sys, os
+import sqlite3, json, time, threading, collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import db, generate
+
+
+class TTLCache:
+    """
+        Thread safe LRU cache whose entries expire `ttl` seconds after they were stored
+    """
+
+    def __init__(self, size=256, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class Statistics:
+    """
+        Results of the report statistics of database "name.db". They are
+        restored from the aggregates stored by generate.py and kept in
+        memory, and the messages dumped after them are added when the
+        database has grown, at most every `interval` seconds. The database
+        is only read: senders without a stored user key get one in a temp
+        users table, and nothing is persisted.
+    """
+
+    def __init__(self, name, args, interval=10.0):
+        self.name = name
+        self.args = args
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.until = None
+        self.version = 0
+        self.results = {}
+        self.names = {}
+        self.accumulators = None
+        # High-water marks of the restored aggregates, and whether the
+        # stored talker rollups hold the messages before the ones in memory
+        self.marks = None
+        self.rollups = False
+
+        # The statistics run inside generate.py's module state
+        generate.conn = sqlite3.connect("%s.db" % name, check_same_thread=False)
+        generate.c = generate.conn.cursor()
+        generate.tokenizer = generate.Tokenizer(args.alphabet)
+        generate.timezone = args.timezone
+
+    def stored_marks(self):
+        """
+            Return dict of statistic name to the high-water mark of its stored aggregate
+        """
+
+        if not generate.c.execute("SELECT name FROM sqlite_master WHERE name = 'aggregates';").fetchone():
+            return {}
+        return dict(generate.c.execute("SELECT name, last_rowid FROM aggregates;").fetchall())
+
+    def restore(self, rebuild=False):
+        """
+            Start over from the stored aggregates and a copy of the stored users
+        """
+
+        self.accumulators = generate.report_statistics(self.args)
+        self.marks = self.stored_marks()
+        if self.marks and not rebuild:
+            generate.restore(self.accumulators)
+        self.rollups = "daily" in self.accumulators and self.accumulators["daily"].since > 0
+
+        stored = generate.c.execute("SELECT name FROM sqlite_master WHERE name = 'users';").fetchone()
+        generate.c.execute("DROP TABLE IF EXISTS temp.users;")
+        db.create_users(generate.c, temp=True)
+        if stored:
+            generate.c.execute("INSERT INTO temp.users SELECT * FROM main.users;")
+        generate.conn.commit()
+
+    def refresh(self):
+        with self.lock:
+            if time.time() - self.checked < self.interval:
+                return
+            self.checked = time.time()
+
+            try:
+                self.update()
+            except sqlite3.OperationalError as e:
+                generate.conn.rollback()
+                print("Statistics not updated, serving the previous ones: %s" % e)
+
+    def update(self):
+        until = generate.c.execute("SELECT IFNULL(MAX(rowid), 0) FROM messages;").fetchone()[0]
+        marks = self.stored_marks()
+        if until == self.until and marks == self.marks:
+            return
+
+        # Aggregates stored by generate.py meanwhile replace the ones in memory
+        start = time.time()
+        if self.accumulators is None or marks != self.marks:
+            self.restore(self.args.rebuild and self.accumulators is None)
+
+        # Same incremental scan as generate.py, only new messages are read.
+        # Users of the temp table shadow the stored ones.
+        stats = list(self.accumulators.values())
+        db.add_users(generate.c, db.new_senders(generate.c, min(stat.since for stat in stats)))
+        generate.conn.commit()
+        results = dict(zip(self.accumulators.keys(), generate.scan(stats, until, users=False)))
+        for stat in stats:
+            stat.since = until
+        for label in ["words", "emojis"]:
+            if label in self.accumulators:
+                results[label + "_error"] = self.accumulators[label].error_bound()
+
+        # Users are keyed by integers until the output
+        self.names = db.user_names(generate.c)
+        generate.resolve_names(results, self.names)
+        self.results = results
+        self.until = until
+        self.version += 1
+        print("Statistics of %d messages updated in %.2f s" % (until, time.time() - start))
+
+    def talkers(self, first=None, last=None):
+        with self.lock:
+            # The stored rollups end at the restored mark, later messages are counted in memory
+            totals = generate.pending_totals(self.accumulators["daily"], self.rollups)
+            return generate.resolve_names({"talkers": totals(first, last)}, self.names)["talkers"]
+
+
+def in_range(date, params):
+    return (params["since"] is None or date >= params["since"]) and (params["until"] is None or date <= params["until"])
+
+
+def talkers_json(stats, params):
+    talkers = sorted(stats.talkers(params["since"], params["until"]), key=lambda x: x[1][0], reverse=True)
+    return [{"name": name, "messages": messages, "words": words, "stickers": stickers, "photos": photos}
+            for name, (messages, words, stickers, photos) in talkers[:params["limit"]]]
+
+
+def messages_json(stats, params):
+    return [[date.isoformat(), count] for date, count in sorted(stats.results["messages"].items())
+            if in_range(date.isoformat(), params)]
+
+
+def population_json(stats, params):
+    return [[date.isoformat(), total, joined, left] for date, (total, joined, left) in sorted(stats.results["population"].items())
+            if in_range(date.isoformat(), params)]
+
+
+def topics_json(stats, params):
+    return [{"time": changed.isoformat(), "title": title, "name": name} for changed, title, name in stats.results["topics"]
+            if in_range(changed.date().isoformat(), params)][:params["limit"]]
+
+
+def activity_json(stats, params):
+    return stats.results["activity"]
+
+
+def rates_json(stats, params):
+    return [{"window": window, "messages": rate, "start": start.isoformat(), "end": end.isoformat()}
+            for window, (rate, start, end) in sorted(stats.results["rate"].items())]
+
+
+def bots_json(stats, params):
+    cmds, bots = stats.results["bots"]
+    return {
+        "bots": [{"name": bot, "count": count} for bot, count in bots[:params["limit"]]],
+        "commands": [{"command": cmd, "users": [{"name": user, "count": count} for user, count in users[:params["limit"]]]}
+                     for cmd, users in cmds]
+    }
+
+
+def emojis_json(stats, params):
+    return {"error": stats.results["emojis_error"],
+            "emojis": [{"emoji": chr(emoji), "code": "%x" % emoji, "count": count} for emoji, count in stats.results["emojis"][:params["limit"]]]}
+
+
+def words_json(stats, params):
+    return {"error": stats.results["words_error"],
+            "words": [{"word": word, "count": count} for word, count in stats.results["words"][:params["limit"]]]}
+
+
+# Endpoint: (function, statistic it needs, accepts since/until, accepts limit)
+ENDPOINTS = {
+    "/talkers": (talkers_json, "daily", True, True),
+    "/messages": (messages_json, "messages", True, False),
+    "/population": (population_json, "population", True, False),
+    "/topics": (topics_json, "topics", True, True),
+    "/activity": (activity_json, "activity", False, False),
+    "/rates": (rates_json, "rate", False, False),
+    "/bots": (bots_json, "bots", False, True),
+    "/emojis": (emojis_json, "emojis", False, True),
+    "/words": (words_json, "words", False, True),
+}
+
+
+def parse_params(query, ranged, limited):
+    """
+        Validate the query parameters. Raises ValueError on invalid ones.
+    """
+
+    values = parse_qs(query)
+    unknown = set(values) - {"since", "until", "limit"}
+    if unknown:
+        raise ValueError("Unknown parameters %s" % ", ".join(sorted(unknown)))
+    if not ranged and ("since" in values or "until" in values):
+        raise ValueError("Time range is not supported, the statistic is over all messages")
+    if not limited and "limit" in values:
+        raise ValueError("Limit is not supported, the answer is not a ranked list")
+
+    params = {}
+    for param in ["since", "until"]:
+        params[param] = generate.iso_date(values[param][-1]) if param in values else None
+    params["limit"] = int(values["limit"][-1]) if "limit" in values else 100
+    if params["limit"] < 0:
+        raise ValueError("Negative limit")
+    return params
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    stats = None
+    cache = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.stats.refresh()
+        if url.path == "/":
+            return self.send_json(200, {"endpoints": sorted(path for path, endpoint in ENDPOINTS.items() if endpoint[1] in self.stats.results),
+                                        "messages": self.stats.until})
+
+        if url.path not in ENDPOINTS:
+            return self.send_json(404, {"error": "No such endpoint %s" % url.path})
+        function, label, ranged, limited = ENDPOINTS[url.path]
+
+        try:
+            params = parse_params(url.query, ranged, limited)
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+
+        if label not in self.stats.results:
+            return self.send_json(404, {"error": "Statistic %s is disabled" % label})
+
+        # Answers are cached until the statistics change or they expire
+        key = (self.stats.version, url.path, tuple(sorted(params.items())))
+        body = self.cache.get(key)
+        if body is None:
+            body = json.dumps(function(self.stats, params), ensure_ascii=False).encode()
+            self.cache.put(key, body)
+        self.send_body(200, body)
+
+    def send_json(self, status, value):
+        self.send_body(status, json.dumps(value, ensure_ascii=False).encode())
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve the statistics of a chat as JSON over HTTP')
+    parser.add_argument('name', type=str, help="Database name")
+    generate.add_report_arguments(parser)
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen")
+    parser.add_argument('--refresh', type=float, default=10.0, help="Seconds between checks for new messages")
+    parser.add_argument('--cache-entries', type=int, default=256, help="Number of cached answers")
+    parser.add_argument('--ttl', type=float, default=60.0, help="Seconds an answer is cached")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    args = parser.parse_args()
+
+    if not os.path.exists("%s.db" % args.name):
+        print("No such database %s.db" % args.name)
+        sys.exit(1)
+
+    Handler.stats = Statistics(args.name, args, args.refresh)
+    if db.missing_columns(generate.c):
+        print("Outdated database schema! Run ./dump.py %s --migrate" % args.name)
+        sys.exit(1)
+
+    Handler.cache = TTLCache(args.cache_entries, args.ttl)
+    Handler.stats.refresh()
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.verbose = args.verbose
+    print("Serving %s on http://%s:%d/" % (args.name, args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()